@@ -1,5 +1,13 @@
+import multiprocessing
 import os
 import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from functools import lru_cache
+from multiprocessing import shared_memory
 import cv2
 import numpy as np
 import pymupdf as fitz
@@ -8,17 +16,41 @@ def crop_image(image, x, y, w, h):
 	# Crop the image using the provided coordinates
 	return image[y:y+h, x:x+w]
 
+PARALLEL_RENDER_MIN_PAGES = 3  # fewer pages than this render in-process
+# Render processes shared by every upload in this server process
+RENDER_POOL_SIZE = min(4, os.cpu_count() or 1)
+
+@lru_cache(maxsize=256)
 def to_px(mm, dpi=300):
 	"""Convert millimeters to pixels at the given DPI."""
 	return int(mm * dpi / 25.4)
 
+@lru_cache(maxsize=256)
 def to_mm(px, dpi=300):
 	"""Convert pixels to millimeters at the given DPI."""
 	return px * 25.4 / dpi
 
-def create_blank_page(width, height):
-	"""Create a blank page with the specified width and height."""
-	return np.ones((height, width), dtype=np.uint8) * 255  # White page
+# Output page formats, in mm
+PAGE_FORMATS = {
+	"A4": {
+		'width': 210, 'height': 297,
+		'margins': {'top': 20, 'bottom': 15, 'left': 15, 'right': 15},
+		'title_area': 30,  # Space for title on first page
+	},
+}
+
+@lru_cache(maxsize=None)
+def _page_geometry(page_format: str, dpi: int) -> dict:
+	"""Page format converted to pixels at the given DPI (computed once per pair)."""
+	if page_format not in PAGE_FORMATS:
+		raise ValueError(f"Unsupported page format: {page_format}")
+	fmt = PAGE_FORMATS[page_format]
+	return {
+		'width': to_px(fmt['width'], dpi),
+		'height': to_px(fmt['height'], dpi),
+		'margins': {side: to_px(mm, dpi) for side, mm in fmt['margins'].items()},
+		'title_area': to_px(fmt['title_area'], dpi),
+	}
 
 def rects_collide(a, b):
 	"""Check if two rectangles (x, y, w, h, ...) overlap."""
@@ -30,50 +62,283 @@ def x_overlaps(a, b):
 	"""Check if two rectangles (x, y, w, h, ...) share horizontal space."""
 	return a[0] < b[0] + b[2] and b[0] < a[0] + a[2]
 
+_UNSAFE_CHARS = str.maketrans('', '', '\x00/\\')
+_NON_PRINTABLE_RE = re.compile(r'[^\x20-\x7E]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+@lru_cache(maxsize=1024)
 def sanitize_string(value: str) -> str:
 	"""Sanitize user-provided strings for use in filenames and paths.
 	Strips path separators, null bytes, and non-printable characters.
-	Returns empty string for None input.
+	Returns empty string for None input. Memoized: partitioning sanitizes
+	the same handful of part names once per strip.
 	"""
 	if value is None:
 		return ""
-	value = value.replace('\x00', '').replace('/', '').replace('\\', '')
-	value = re.sub(r'[^\x20-\x7E]', '', value)
-	value = re.sub(r'\s+', ' ', value).strip()
+	value = value.translate(_UNSAFE_CHARS)
+	value = _NON_PRINTABLE_RE.sub('', value)
+	value = _WHITESPACE_RE.sub(' ', value).strip()
 	return value[:128]
 
 class Score:
-	def __init__(self, path: str, title: str = None, composer: str = None, keep_temp_files: bool = False):
+	def __init__(self, path: str = None, title: str = None, composer: str = None, keep_temp_files: bool = False,
+				 stream: bytes = None):
+		"""Open a score from a file ``path`` or from in-memory PDF bytes (``stream``)."""
+		if (path is None) == (stream is None):
+			raise ValueError("Exactly one of 'path' or 'stream' must be given")
 		self.keep_temp_files = keep_temp_files
 		self.title = sanitize_string(title)
 		self.composer = sanitize_string(composer)
 		self.name = f"{self.composer}_{self.title}"
 		self.path = path
+		self.stream = stream
 		self.doc = self._load_pdf()
 		self.pages: list[Page] = []
+		self.pages_tensor: np.ndarray = None  # (n, H, W) when all pages share a size
 		self.parts: list[Part] = []
 		self.parts_dict: dict[str, Part] = {}
 	
 	def _load_pdf(self):
 		"""Load the PDF file and extract pages."""
-		if not os.path.exists(self.path):
-			raise FileNotFoundError(f"File not found: {self.path}")
-		# Open the PDF file
-		doc = fitz.open(self.path)
+		if self.stream is not None:
+			return fitz.open(stream=self.stream, filetype="pdf")
+		# Let the open itself report a missing file (no separate stat)
+		try:
+			doc = fitz.open(self.path)
+		except fitz.FileNotFoundError as e:
+			raise FileNotFoundError(f"File not found: {self.path}") from e
 		return doc
 	
-	def _extract_pages(self, dpi=300):
-		for page_number, page in enumerate(self.doc):
-			# Render the page to a pixmap without transparency (alpha) and in grayscale
-			pix = page.get_pixmap(dpi=dpi, alpha=False, colorspace="gray")
+	def _extract_pages(self, dpi=300, max_workers=None):
+		"""Render every page of the PDF into a grayscale Page.
+
+		Pages are rasterized on the shared render pool (one fitz.Document
+		per worker — documents can't be shared across threads) when the
+		score has enough pages and more than one worker is allowed, with at
+		most ``max_workers`` of this score's pages in flight at a time.
+		Workers open the PDF by path, or an in-memory stream from shared
+		memory (never a file on disk). Results are collected in page order.
+		"""
+		page_count = self.doc.page_count
+		workers = _get_max_workers(page_count, max_workers)
+		if workers <= 1:
+			self._add_pages(Page.from_pixmap(_render_pixmap(page, dpi), score=self) for page in self.doc)
+			return
+		source = self.path if self.path is not None else self.stream
+		rendered = _render_in_pool(source, page_count, dpi, workers)
+		self._add_pages(Page.from_samples(*r, score=self) for r in rendered)
+
+	def _add_pages(self, pages):
+		"""Append rendered pages in order (writing debug copies if asked).
+
+		Pages are copied into one contiguous (n, H, W) block as they arrive,
+		allocated once the first page's size is known, and each Page.img
+		becomes a view into ``pages_tensor`` so whole-score NumPy ops can run
+		in a single call instead of once per page. Each render buffer is
+		released right after its copy, so the pages are never held twice.
+		Scores with mixed page sizes get no ``pages_tensor``: at the first
+		odd-sized page the pages so far are copied out of the block, which
+		is then dropped, and every page keeps its own buffer.
+		"""
+		tensor = None
+		for page_number, page in enumerate(pages):
+			if page_number == 0:
+				tensor = np.empty((self.doc.page_count,) + page.img.shape, dtype=np.uint8)
+			if tensor is not None and page.img.shape == tensor.shape[1:]:
+				tensor[page_number] = page.img
+				page.img = tensor[page_number]
+				page._pixmap = None  # render buffer no longer referenced
+			elif tensor is not None:
+				# Mixed sizes: give earlier pages their own buffers so the
+				# partly filled block can be freed
+				for earlier in self.pages[-page_number:]:
+					earlier.img = earlier.img.copy()
+				tensor = None
 			if self.keep_temp_files:
+				# Debug copy only: written from the decoded array, never re-read
 				page_path = os.path.join(TMP_DIR, f"{self.name}_page_{page_number}.png")
-				pix.save(page_path, output='png')
-				page = Page.from_path(path=page_path, score=self, grayscale=True)
-			else:
-				page = Page.from_pixmap(pix, score=self)
+				cv2.imwrite(page_path, page.img)
+				page.path = page_path
 			# Append the page to the score
 			self.pages.append(page)
+		self.pages_tensor = tensor
+
+	def spill_pages(self, directory: str):
+		"""Write page images to .npy files in ``directory`` and memory-map
+		them back (read-only), releasing the resident copies.
+
+		Pages stay usable — the OS pages them in on demand — so an idle
+		score can be kept without holding its pixels in RAM. Staff bands are
+		re-cut from the mapped pages; header and marking crops are small
+		and are copied so they don't pin the old buffers.
+
+		Other request threads may be reading this score meanwhile, so every
+		replacement array is built first and then published with plain
+		attribute assignments: a reader sees each image either before or
+		after the swap (same pixels), never a half-written one.
+		"""
+		os.makedirs(directory, exist_ok=True)
+		pages = list(self.pages)
+		tensor = None
+		if self.pages_tensor is not None:
+			path = os.path.join(directory, "pages.npy")
+			np.save(path, self.pages_tensor)
+			tensor = np.load(path, mmap_mode='r')
+			mapped = list(tensor)
+		else:
+			mapped = []
+			for page_number, page in enumerate(pages):
+				path = os.path.join(directory, f"page_{page_number}.npy")
+				np.save(path, page.img)
+				mapped.append(np.load(path, mmap_mode='r'))
+		staff_imgs = []
+		marking_imgs = []
+		copies = {}  # one marking crop is shared by every staff in its system
+		for page, img in zip(pages, mapped):
+			for staff in list(page.staves):
+				staff_imgs.append((staff, img[staff.y:staff.y + staff.h]))
+				for marking in list(staff.markings):
+					crop = marking['img']
+					if id(crop) not in copies:
+						copies[id(crop)] = (crop, crop.copy())  # keep crop alive so its id isn't reused
+					marking_imgs.append((marking, copies[id(crop)][1]))
+		parts = list(self.parts)
+		headers = [(part, part.header_img.copy()) for part in parts if part.header_img is not None]
+
+		if tensor is not None:
+			self.pages_tensor = tensor
+		for page, img in zip(pages, mapped):
+			page.img = img
+			page._pixmap = None
+		for staff, img in staff_imgs:
+			staff.img = img
+		for marking, img in marking_imgs:
+			marking['img'] = img
+		for part, img in headers:
+			part.header_img = img
+		for part in parts:
+			# Unscaled entries may be views of the old buffers
+			part._scaled_staves_width = None
+
+def _get_max_workers(page_count: int, max_workers: int = None) -> int:
+	"""Number of this score's pages to render concurrently: never more than
+	pages or pool processes. Short documents render in-process — below
+	PARALLEL_RENDER_MIN_PAGES the pixel transfer costs more than it saves."""
+	if page_count < PARALLEL_RENDER_MIN_PAGES:
+		return 1
+	if max_workers is None:
+		max_workers = RENDER_POOL_SIZE
+	return max(1, min(max_workers, RENDER_POOL_SIZE, page_count))
+
+@lru_cache(maxsize=None)
+def _render_matrix(dpi: int) -> fitz.Matrix:
+	"""Zoom matrix for rendering at ``dpi`` (PDF space is 72 DPI). Shared — don't mutate."""
+	zoom = dpi / 72
+	return fitz.Matrix(zoom, zoom)
+
+def _render_pixmap(page: fitz.Page, dpi: int) -> fitz.Pixmap:
+	"""Render a PDF page to a pixmap without transparency (alpha) and in grayscale."""
+	return page.get_pixmap(matrix=_render_matrix(dpi), colorspace=fitz.csGRAY, alpha=False)
+
+_render_pool: ProcessPoolExecutor = None
+_render_pool_lock = threading.Lock()
+
+def _get_render_pool() -> ProcessPoolExecutor:
+	"""The process-wide render pool, started on first use.
+
+	Workers come from a forkserver (spawn where that's unavailable), never
+	a plain fork: forking a threaded server can copy a lock another thread
+	holds — MuPDF's, logging's, the session store's — into the child,
+	which then deadlocks on it.
+	"""
+	global _render_pool
+	with _render_pool_lock:
+		if _render_pool is None:
+			if "forkserver" in multiprocessing.get_all_start_methods():
+				context = multiprocessing.get_context("forkserver")
+				# The fork server imports this module up front (instead of
+				# the app's __main__), so workers start with MuPDF loaded.
+				context.set_forkserver_preload([__name__])
+			else:
+				context = multiprocessing.get_context("spawn")
+			_render_pool = ProcessPoolExecutor(max_workers=RENDER_POOL_SIZE, mp_context=context)
+		return _render_pool
+
+def _render_in_pool(source, page_count: int, dpi: int, in_flight: int):
+	"""Render every page of a PDF — a path, or the document's bytes — on
+	the shared pool.
+
+	Yields (samples, width, height, n) in page order, keeping at most
+	``in_flight`` pages submitted ahead of the one being consumed, so
+	concurrent uploads share the workers instead of queueing whole scores.
+	Bytes are copied once into a shared memory block that every task
+	reads, rather than pickled into each task; the block is freed when
+	rendering ends.
+	"""
+	global _render_pool
+	pool = _get_render_pool()
+	shm = None
+	if not isinstance(source, str):
+		shm = shared_memory.SharedMemory(create=True, size=max(1, len(source)))
+		shm.buf[:len(source)] = source
+		source = (shm.name, len(source))
+	futures = deque()
+	next_page = 0
+	try:
+		while futures or next_page < page_count:
+			while next_page < page_count and len(futures) < in_flight:
+				futures.append(pool.submit(_render_page_samples, source, next_page, dpi))
+				next_page += 1
+			yield futures.popleft().result()
+	except BrokenProcessPool:
+		# A worker died; start a fresh pool for the next upload
+		with _render_pool_lock:
+			if _render_pool is pool:
+				_render_pool = None
+		raise
+	finally:
+		for future in futures:
+			future.cancel()
+		if shm is not None:
+			wait(futures)  # pages already running still read the block
+			shm.close()
+			shm.unlink()
+
+@contextmanager
+def _open_render_source(source):
+	"""Open a worker's document from a path or a (shared memory name, size)
+	pair, and close it (and the shared memory) on exit. A memoryview of
+	the shared block opens without a copy."""
+	if isinstance(source, str):
+		doc = fitz.open(source)
+		try:
+			yield doc
+		finally:
+			doc.close()
+		return
+	name, size = source
+	shm = shared_memory.SharedMemory(name=name)
+	view = shm.buf[:size]
+	doc = fitz.open(stream=view, filetype="pdf")
+	try:
+		yield doc
+	finally:
+		doc.close()
+		del doc
+		view.release()
+		shm.close()
+
+def _render_page_samples(source, page_number: int, dpi: int):
+	"""Render a single page in a worker process.
+
+	The document is opened for this page and closed again, so a worker
+	holds nothing between tasks: opening costs well under a millisecond
+	per page next to a 300 DPI render. Returns (samples, width, height,
+	n) — raw bytes are cheap to pickle back to the parent, unlike a Pixmap.
+	"""
+	with _open_render_source(source) as doc:
+		pix = _render_pixmap(doc[page_number], dpi)
+	return pix.samples, pix.width, pix.height, pix.n
 
 class PageError(Exception):
 	"""Base exception for Page-related errors."""
@@ -89,45 +354,85 @@ class Page:
 		self.path: str = None
 		self.staves: list[Staff] = []
 		self.img = None
+		self.height: int = 0  # img dimensions, fixed once the page is loaded
+		self.width: int = 0
+		self._pixmap = None  # keeps a zero-copy pixmap buffer alive behind img
 	
 	@classmethod
 	def from_path(cls, path: str, score: Score = None, grayscale: bool = True):
 		"""Create a Page instance from a file path."""
 		page = cls(score=score)
 		page.path = path
-		if not os.path.exists(path):
-			raise PageLoadError(f"File not found: {path}")
 		page.img = cv2.imread(path, cv2.IMREAD_GRAYSCALE) if grayscale else cv2.imread(path)
 		if page.img is None:
+			# imread returns None for both cases; stat only to word the error
+			if not os.path.exists(path):
+				raise PageLoadError(f"File not found: {path}")
 			raise PageLoadError(f"Failed to load image: {path}")
+		page.height, page.width = page.img.shape[:2]
 		return page
 
 	@classmethod
 	def from_pixmap(cls, pixmap: fitz.Pixmap, score: Score = None):
 		page = cls(score=score)
 		page.img = cls._pixmap_to_numpy(pixmap)
+		page._pixmap = pixmap
+		page.height, page.width = pixmap.height, pixmap.width
 		return page
 
-	def to_png_bytes(self) -> bytes:
-		"""Encode the page image as PNG bytes for HTTP response."""
-		success, buffer = cv2.imencode('.png', self.img)
+	@classmethod
+	def from_samples(cls, samples: bytes, width: int, height: int, n: int, score: Score = None):
+		"""Create a Page from raw pixmap samples (e.g. rendered in another process)."""
+		page = cls(score=score)
+		page.img = cls._samples_to_numpy(samples, width, height, n)
+		page.height, page.width = height, width
+		return page
+
+	def to_png_bytes(self, width: int = None) -> bytes:
+		"""Encode the page image as PNG bytes for HTTP response, optionally
+		downscaled to ``width`` pixels (see ``display_img``)."""
+		# No params on purpose: OpenCV's default is already its fastest PNG
+		# path here; an explicit IMWRITE_PNG_COMPRESSION level is ~2-3x slower.
+		success, buffer = cv2.imencode('.png', self.display_img(width))
 		if not success:
 			raise PageError("Failed to encode page image as PNG")
 		return buffer.tobytes()
 
+	def to_webp_bytes(self, quality: int = 85, width: int = None) -> bytes:
+		"""Encode the page image as lossy WebP bytes (display only; output
+		parts are always built from the full-quality pixels)."""
+		success, buffer = cv2.imencode('.webp', self.display_img(width), [cv2.IMWRITE_WEBP_QUALITY, quality])
+		if not success:
+			raise PageError("Failed to encode page image as WebP")
+		return buffer.tobytes()
+
+	def display_img(self, width: int = None) -> np.ndarray:
+		"""The page image scaled down to ``width`` pixels wide (aspect kept)
+		for on-screen display. Returns ``img`` itself when ``width`` is None
+		or not smaller than the page."""
+		if width is None or width >= self.width:
+			return self.img
+		height = max(1, round(self.height * width / self.width))
+		return cv2.resize(self.img, (width, height), interpolation=cv2.INTER_AREA)
+
 	@staticmethod
 	def _pixmap_to_numpy(pixmap):
-		"""Convert a PyMuPDF pixmap to a NumPy array."""
-		# Get pixmap info
-		samples = pixmap.samples
-		width = pixmap.width
-		height = pixmap.height
-		
-		# Create numpy array from pixmap samples
-		if pixmap.n == 1:  # Grayscale
+		"""Convert a PyMuPDF pixmap to a NumPy array.
+
+		Wraps ``samples_mv`` (a memoryview over the pixmap's own memory)
+		instead of ``samples``, which would copy the whole page into a new
+		bytes object. The caller must keep the pixmap alive as long as the
+		array is used.
+		"""
+		return Page._samples_to_numpy(pixmap.samples_mv, pixmap.width, pixmap.height, pixmap.n)
+
+	@staticmethod
+	def _samples_to_numpy(samples, width, height, n):
+		"""Wrap raw pixmap samples as a NumPy array."""
+		if n == 1:  # Grayscale
 			return np.frombuffer(samples, dtype=np.uint8).reshape(height, width)
 		else:  # RGB or RGBA
-			return np.frombuffer(samples, dtype=np.uint8).reshape(height, width, pixmap.n)
+			return np.frombuffer(samples, dtype=np.uint8).reshape(height, width, n)
 
 class StaffError(Exception):
 	"""Base exception for Staff-related errors."""
@@ -146,15 +451,19 @@ class Staff:
 		self.source_page_width = None
 
 	def _crop(self):
+		"""Return the staff's full-width band of the page image.
+
+		This is a view, not a copy: ``img`` aliases ``page.img``, so the page
+		must not be mutated in place while its staves are in use.
+		"""
 		if self.page is None:
 			raise StaffError("Page not set for this staff.")
-		x, w = (0, self.page.img.shape[1])
-		y, h = (self.y, self.h)
-		try:
-			img = crop_image(self.page.img, x, y, w, h)
-		except Exception as e:
-			raise StaffError(f"Error cropping staff image: {e}")
-		return img
+		if self.y < 0 or self.h <= 0 or self.y + self.h > self.page.height:
+			raise StaffError(
+				f"Staff band y={self.y}, h={self.h} is outside the page "
+				f"(height {self.page.height})"
+			)
+		return self.page.img[self.y:self.y + self.h]
 
 class PartError(Exception):
 	"""Base exception for Part-related errors."""
@@ -176,8 +485,10 @@ class Part:
 		self.pages = []
 		self.header_img = None
 		self.header_source_width = None
-		self.width = max([staff.img.shape[1] for staff in staves]) if staves else 0
+		self.width = max((staff.img.shape[1] for staff in staves), default=0)
 		self.spacing = 0
+		self._scaled_staves_cache = []
+		self._scaled_staves_width = None
 	
 	def _reset_y_pos(self):
 		if not self.pages:
@@ -186,8 +497,27 @@ class Part:
 			return self.margins['top']
 	
 	def _adapt_staff(self, staff: Staff):
+		"""Scale a staff to the output width.
+
+		staff.img is a full-width row band of the page, i.e. a C-contiguous
+		view, so cv2.resize reads the page memory directly — crop and resize
+		are already a single pass with no intermediate copy.
+		"""
 		return self._scale_to_width(staff.img)
 
+	def _adapt_staves(self) -> list:
+		"""Scale all staves to available_width as one batch, cached per layout.
+
+		preview_metadata, the stave preview endpoint and process() all need the
+		same scaled images, so they are resized once and reused until the
+		available width changes (spacing tweaks don't affect it).
+		"""
+		if (self._scaled_staves_width != self.available_width
+				or len(self._scaled_staves_cache) != len(self.staves)):
+			self._scaled_staves_cache = [self._adapt_staff(staff) for staff in self.staves]
+			self._scaled_staves_width = self.available_width
+		return self._scaled_staves_cache
+
 	def _scale_to_width(self, img):
 		"""Scale an image to fit available_width, preserving aspect ratio."""
 		h, w = img.shape[:2]
@@ -195,12 +525,20 @@ class Part:
 		return self._scale_img(img, scale)
 
 	def _scale_img(self, img, scale):
-		"""Scale an image by the given factor."""
-		if scale == 1.0:
-			return img
+		"""Scale an image by the given factor.
+
+		Returns the input unchanged when the target size equals the source
+		size (e.g. source already rendered at the output width), so the
+		resize is skipped for near-1.0 factors too, not only exact ones.
+		"""
 		h, w = img.shape[:2]
 		new_w = int(w * scale)
 		new_h = int(h * scale)
+		if (new_w, new_h) == (w, h):
+			return img
+		# INTER_AREA averages every source pixel into the output, so thin staff
+		# lines survive large downscales without aliasing (no need for a
+		# separate Lanczos/pyvips path). Upscales go through Lanczos.
 		interp = cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LANCZOS4
 		return cv2.resize(img, (new_w, new_h), interpolation=interp)
 
@@ -210,30 +548,20 @@ class Part:
 		return self._scale_img(self.header_img, scale)
 
 	def _layout(self, page_format: str = "A4", dpi: int = 300):
-		if page_format == "A4": # in mm
-			width_mm, height_mm = 210, 297
-			margins_mm = {'top': 20, 'bottom': 15, 'left': 15, 'right': 15}
-			title_area_mm = 30  # Space for title on first page
-			system_spacing_mm = getattr(self, '_custom_spacing_mm', 12)
-			# Convert to pixels — width/height are FULL page dimensions
-			self.width = to_px(width_mm, dpi)
-			self.height = to_px(height_mm, dpi)
-			self.spacing = to_px(system_spacing_mm, dpi)
-			self.margins = {
-				'top': to_px(margins_mm['top'], dpi),
-				'bottom': to_px(margins_mm['bottom'], dpi),
-				'left': to_px(margins_mm['left'], dpi),
-				'right': to_px(margins_mm['right'], dpi)
-			}
-		else:
-			raise ValueError(f"Unsupported page format: {page_format}")
+		geometry = _page_geometry(page_format, dpi)
+		system_spacing_mm = getattr(self, '_custom_spacing_mm', 12)
+		# Width/height are FULL page dimensions, in pixels
+		self.width = geometry['width']
+		self.height = geometry['height']
+		self.spacing = to_px(system_spacing_mm, dpi)
+		self.margins = dict(geometry['margins'])
 		self.available_width = self.width - self.margins['left'] - self.margins['right']
 		# Compute title_area from header image if present, otherwise use default
 		if self.header_img is not None:
 			scaled_header = self._scale_header()
 			self.title_area = scaled_header.shape[0] + self.spacing
 		else:
-			self.title_area = to_px(title_area_mm, dpi)
+			self.title_area = geometry['title_area']
 		self.available_height = self.height - self.margins['top'] - self.margins['bottom']
 
 	def _paste_img_on_page(self, page, img, out_y, out_x):
@@ -326,8 +654,6 @@ class Part:
 		Does NOT render pages — just computes dimensions so the frontend
 		can paginate client-side.
 		"""
-		if self.staves:
-			self.width = max(staff.img.shape[1] for staff in self.staves)
 		self.dpi = 300
 		self._layout(dpi=self.dpi)
 
@@ -337,8 +663,9 @@ class Part:
 			header_meta = {"scaled_height": scaled.shape[0]}
 
 		staves_meta = []
+		scaled_imgs = self._adapt_staves()
 		for i, staff in enumerate(self.staves):
-			scaled = self._adapt_staff(staff)
+			scaled = scaled_imgs[i]
 			# Compute the overhead from markings that sit above the staff
 			markings_overhead = 0
 			if staff.markings and staff.source_page_width:
@@ -388,8 +715,6 @@ class Part:
 				force a page break. Staves before the break are justified to
 				fill the page.
 		"""
-		if self.staves:
-			self.width = max(staff.img.shape[1] for staff in self.staves)
 		self.dpi = 300
 		self._layout(dpi=self.dpi)
 
@@ -397,18 +722,53 @@ class Part:
 			offsets = [0] * len(self.staves)
 		breaks = set(page_breaks_after) if page_breaks_after else set()
 
+		scaled_imgs = self._adapt_staves()
+		for staff, img in zip(self.staves, scaled_imgs):
+			if img.shape[1] > self.available_width:
+				raise PartError(f"Staff image width exceeds page width: {staff.name}")
+
+		# --- Layout: decide every stave's page and Y before touching pixels ---
+		plan = self._plan_pages([img.shape[0] for img in scaled_imgs], offsets, breaks)
+
+		# --- Render: paste staves at their planned positions ---
+		# Staves are pasted top-to-bottom into disjoint row ranges, so every
+		# destination row is written once, in order — already a streaming
+		# access pattern; tiling the page into cache-sized stripes would only
+		# split the same copies into more, smaller ones. Likewise, stacking the
+		# staves and spacers with np.vstack first would copy every stave twice
+		# (into the stack, then onto the page) for one less slice per stave.
+		scaled_header = None
+		if self.header_img is not None:
+			scaled_header = self._scale_header()
+
+		# All output pages in one white block; each page is a view into it
+		out_pages = np.full((len(plan), self.height, self.width), 255, dtype=np.uint8)
+		for p_idx, (page, placements) in enumerate(zip(out_pages, plan)):
+			# Paste header on first page
+			if p_idx == 0 and scaled_header is not None:
+				sh, sw = scaled_header.shape[:2]
+				x_off = self.margins['left'] + (self.available_width - sw) // 2
+				page[self.margins['top']:self.margins['top'] + sh, x_off:x_off + sw] = scaled_header
+			for idx, y in placements:
+				self._paste_img_on_page(page, scaled_imgs[idx], y, self.margins['left'])
+				self._paste_markings(page, self.staves[idx], y)
+		self.pages.extend(out_pages)
+
+	def _plan_pages(self, heights, offsets, breaks):
+		"""Assign staves to output pages and compute their Y positions.
+
+		Pure layout over scaled stave heights — no image data. Pages with a
+		forced break are justified to fill the page.
+
+		Returns:
+			list of pages, each a list of (stave_index, y) placements.
+		"""
 		# --- Pass 1: assign staves to pages ---
-		page_assignments = [[]]  # list of lists of (stave_index, scaled_img)
+		page_assignments = [[]]  # list of lists of stave indices
 		first_page_start = self.margins['top'] + self.title_area
 		later_page_start = self.margins['top']
 		y_pos = first_page_start
-		scaled_imgs = []
-		for i, staff in enumerate(self.staves):
-			img = self._adapt_staff(staff)
-			scaled_imgs.append(img)
-			if img.shape[1] > self.available_width:
-				raise PartError(f"Staff image width exceeds page width: {staff.name}")
-			staff_h = img.shape[0]
+		for i, staff_h in enumerate(heights):
 			gap = self.spacing + offsets[i] if page_assignments[-1] else 0
 			if page_assignments[-1] and y_pos + gap + staff_h > self.height - self.margins['bottom']:
 				page_assignments.append([])
@@ -417,32 +777,20 @@ class Part:
 				y_pos += self.spacing + offsets[i]
 			page_assignments[-1].append(i)
 			y_pos += staff_h
-			if i in breaks and i < len(self.staves) - 1:
+			if i in breaks and i < len(heights) - 1:
 				page_assignments.append([])
 				y_pos = later_page_start
 
-		# --- Pass 2: render pages, justifying forced-break pages ---
-		# Paste header on first page
-		scaled_header = None
-		if self.header_img is not None:
-			scaled_header = self._scale_header()
-
+		# --- Pass 2: Y positions, justifying forced-break pages ---
+		plan = []
 		for p_idx, indices in enumerate(page_assignments):
 			if not indices:
 				continue
-			page = create_blank_page(self.width, self.height)
-			is_first = (p_idx == 0)
-
-			if is_first and scaled_header is not None:
-				sh, sw = scaled_header.shape[:2]
-				x_off = self.margins['left'] + (self.available_width - sw) // 2
-				page[self.margins['top']:self.margins['top'] + sh, x_off:x_off + sw] = scaled_header
-
-			start_y = self._reset_y_pos() if is_first else self.margins['top']
+			start_y = self._reset_y_pos() if p_idx == 0 else self.margins['top']
 			has_forced_break = any(i in breaks for i in indices)
 
 			# Compute total stave height on this page
-			total_stave_h = sum(scaled_imgs[i].shape[0] for i in indices)
+			total_stave_h = sum(heights[i] for i in indices)
 			num_gaps = len(indices) - 1
 			remaining = (self.height - self.margins['bottom']) - start_y - total_stave_h
 
@@ -452,6 +800,7 @@ class Part:
 			else:
 				gap_size = None  # use normal spacing + offsets
 
+			placements = []
 			y = start_y
 			for j, idx in enumerate(indices):
 				if j > 0:
@@ -459,11 +808,10 @@ class Part:
 						y += int(gap_size)
 					else:
 						y += self.spacing + offsets[idx]
-				staff_img = scaled_imgs[idx]
-				self._paste_img_on_page(page, staff_img, y, self.margins['left'])
-				self._paste_markings(page, self.staves[idx], y)
-				y += staff_img.shape[0]
-			self.pages.append(page)
+				placements.append((idx, y))
+				y += heights[idx]
+			plan.append(placements)
+		return plan
 
 def example_score():
 	try:
@@ -486,12 +834,12 @@ def example():
 	parts_dict = {} # will be a dict attribute of the score
 	h = 50
 	for page in score.pages:
-		cuts = range(0, page.img.shape[0], h) # example cut positions all at the same distance
+		cuts = range(0, page.height, h) # example cut positions all at the same distance
 		for cut in cuts:
 			# Create a staff for each cut
 			name = names[name_idx]
 			short_name = short_names[name_idx]
-			staff = Staff(name, short_name, cut, h, page)
+			staff = Staff(name, short_name, cut, min(h, page.height - cut), page)
 			# Append the staff to the page
 			page.staves.append(staff)
 			# Add the staff to the right part
@@ -1,14 +1,26 @@
+import atexit
 import logging
 import os
 import io
+import hashlib
+import re
+import shutil
+import tempfile
+import threading
 import uuid
 import time
 import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import numpy as np
+import orjson
 import pymupdf as fitz
-from flask import Flask, request, jsonify, send_file, abort
+from flask import Flask, Response, request, jsonify, send_file, abort
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
+from urllib.parse import quote, unquote
+from werkzeug.exceptions import RequestEntityTooLarge
 from analyzer import (
 	Score, Staff, Part, TMP_DIR,
 	sanitize_string, PageError, StaffError, PartError
@@ -20,33 +32,198 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+	"""Serialize responses with orjson: detection and partition payloads are
+	long int lists, which orjson encodes several times faster than the
+	stdlib, and NumPy scalars/arrays pass through without conversion."""
+
+	_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+	def dumps(self, obj, **kwargs) -> str:
+		return orjson.dumps(obj, option=self._OPTIONS).decode()
+
+	def loads(self, s, **kwargs):
+		return orjson.loads(s)
+
+	def response(self, *args, **kwargs) -> Response:
+		obj = self._prepare_response_obj(args, kwargs)
+		return self._app.response_class(orjson.dumps(obj, option=self._OPTIONS), mimetype='application/json')
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 CORS(app, origins=os.getenv('CORS_ORIGINS', '*').split(','))
 
 MAX_UPLOAD_SIZE_MB = 50
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+RAW_UPLOAD_MIMETYPES = {'application/pdf', 'application/octet-stream'}
+
+# When set (e.g. '/protected/parts'), part PDFs are written under PARTS_DIR
+# and handed to the reverse proxy with X-Accel-Redirect instead of being
+# streamed by the worker. The proxy needs an `internal` location at this
+# prefix aliased to PARTS_DIR.
+ACCEL_REDIRECT_PREFIX = os.getenv('ACCEL_REDIRECT_PREFIX', '').rstrip('/')
+PARTS_DIR = os.path.join(TMP_DIR, 'parts')
+# Memory-mapped pages of idle sessions go in a directory of this process's
+# own under SPILL_DIR, made on first spill and removed at exit. SPILL_DIR
+# itself may be shared (other workers, other apps), so nothing else in it
+# is ever touched. (Removing a file that is still mapped is safe on POSIX;
+# the mapping outlives the name.)
+SPILL_DIR = os.getenv('SPILL_DIR') or tempfile.gettempdir()
+_spill_root: str = None
+_spill_root_lock = threading.Lock()
+
+# Flate-compress page images; garbage=4 also drops unused objects and
+# merges identical streams (e.g. repeated blank pages). Plain deflate is
+# left off: the per-page content streams are a few bytes and only grow.
+PDF_SAVE_OPTIONS = {'deflate_images': True, 'garbage': 4}
 
 # In-memory session store: score_id -> { 'score': Score, 'metadata': dict, 'created_at': float }
-scores: dict[str, dict] = {}
+# (plus lazily added 'detection_cache', 'image_cache' and 'partition_rev')
+# Ordered least- to most-recently used: uploads append, access moves to end.
+scores: OrderedDict[str, dict] = OrderedDict()
+# Guards ``scores`` and each entry's image_cache under a threaded server
+# (dev server or gunicorn gthread). Never held across rendering, encoding
+# or disk writes.
+_store_lock = threading.Lock()
 
 MAX_SESSIONS = 50
 SESSION_TTL_SECONDS = 3600  # 1 hour
-
-
-def _evict_expired_sessions():
-	"""Remove sessions older than SESSION_TTL_SECONDS, then evict the oldest
-	if we're still at capacity."""
+MAX_SESSION_MEMORY_MB = 2048  # budget for page images + caches across sessions
+EVICTION_WINDOW = 0.1  # fraction of least-recently-used sessions weighed by cost
+PAGE_IMAGE_CACHE_SIZE = 20  # encoded page images kept per session
+# Serve pages as lossy WebP to clients that accept it: ~10x smaller than PNG
+# for scanned scores. Set SERVE_WEBP=false to always send PNG.
+SERVE_WEBP = os.getenv('SERVE_WEBP', 'true').lower() == 'true'
+PAGE_WEBP_QUALITY = 85
+DISPLAY_WIDTH_STEP = 256  # display widths are bucketed so cache entries get reused
+MAX_RENDER_THREADS = 8  # parts rendered concurrently in generate_parts
+
+
+# Sessions picked for spilling, held here (out of ``scores``) while their
+# pages are written to disk without _store_lock. Still served meanwhile.
+_spilling: dict[str, dict] = {}
+
+
+def _part_pages_bytes(score: Score) -> int:
+	"""Memory held by a score's rendered part pages."""
+	return sum(page.nbytes for part in score.parts for page in part.pages)
+
+
+def _session_bytes(entry: dict) -> int:
+	"""Approximate memory held by a session: page images (unless spilled to
+	disk), cached page images and rendered part pages."""
+	score = entry['score']
+	total = 0 if entry.get('spilled') else sum(page.img.nbytes for page in score.pages)
+	total += sum(len(data) for data, _ in entry.get('image_cache', {}).values())
+	total += _part_pages_bytes(score)
+	return total
+
+
+def _evict_expired_sessions(incoming_bytes: int = 0) -> tuple[list[str], list[str]]:
+	"""Remove sessions older than SESSION_TTL_SECONDS, then make room until
+	we're under both MAX_SESSIONS and MAX_SESSION_MEMORY_MB (counting the
+	session about to be added).
+
+	The TTL sweep checks every session: ``scores`` is in access order, not
+	creation order, once spilled sessions are put back at the cold end
+	(and the store is capped at MAX_SESSIONS anyway). Capacity eviction
+	looks at the coldest EVICTION_WINDOW of sessions in that order and
+	picks the one with the highest memory per hit, so a large score nobody
+	is using goes before a small one that's being worked on. Over the
+	memory budget the victim is first picked for spilling — its pages
+	written to disk and memory-mapped back — and only deleted once every
+	session is spilled or the session count is at its cap.
+
+	Caller must hold ``_store_lock``. Nothing is written or deleted here:
+	sessions to spill are moved to ``_spilling``, and the returned
+	(to_spill, removed) score IDs go to _finish_eviction() once the lock is
+	released.
+	"""
 	now = time.time()
-	expired = [sid for sid, entry in scores.items()
-			   if now - entry.get('created_at', 0) > SESSION_TTL_SECONDS]
-	for sid in expired:
+	removed = [
+		sid for sid, entry in scores.items()
+		if now - entry.get('created_at', 0) > SESSION_TTL_SECONDS
+	]
+	for sid in removed:
 		logger.info("Evicting expired session %s", sid)
 		del scores[sid]
 
-	while len(scores) >= MAX_SESSIONS:
-		oldest = min(scores, key=lambda k: scores[k].get('created_at', 0))
-		logger.info("Evicting oldest session %s (at capacity)", oldest)
-		del scores[oldest]
+	budget = MAX_SESSION_MEMORY_MB * 1024 * 1024
+	sizes = {sid: _session_bytes(entry) for sid, entry in scores.items()}
+	# Sessions already being spilled will only keep their part pages
+	total = sum(sizes.values()) + incoming_bytes
+	total += sum(_part_pages_bytes(entry['score']) for entry in _spilling.values())
+	to_spill = []
+	while scores and (len(scores) + len(_spilling) >= MAX_SESSIONS or total > budget):
+		at_count_cap = len(scores) + len(_spilling) >= MAX_SESSIONS
+		pool = list(scores) if at_count_cap else [
+			sid for sid in scores if not scores[sid].get('spilled')
+		] or list(scores)
+		window = max(1, int(len(pool) * EVICTION_WINDOW))
+		victim = max(pool[:window], key=lambda sid: sizes[sid] / (scores[sid].get('hits', 0) + 1))
+		entry = scores.pop(victim)
+		if not at_count_cap and not entry.get('spilled'):
+			_spilling[victim] = entry
+			to_spill.append(victim)
+			total -= sizes.pop(victim) - _part_pages_bytes(entry['score'])
+			continue
+		logger.info("Evicting session %s (%d MB, at capacity)", victim, sizes[victim] // (1024 * 1024))
+		removed.append(victim)
+		total -= sizes.pop(victim)
+	return to_spill, removed
+
+
+def _finish_eviction(to_spill: list[str], removed: list[str]):
+	"""Disk side of _evict_expired_sessions, run without ``_store_lock``:
+	delete removed sessions' files, then spill each picked session and put
+	it back in the store."""
+	for score_id in removed:
+		_remove_session_files(score_id)
+	for score_id in to_spill:
+		entry = _spilling[score_id]
+		started = time.time()
+		if _spill_session(score_id, entry):
+			logger.info("Spilled session %s to disk (at capacity)", score_id)
+		with _store_lock:
+			del _spilling[score_id]
+			scores[score_id] = entry
+			if entry.get('created_at', 0) < started:
+				# Untouched while spilling: back to the cold end it came from
+				scores.move_to_end(score_id, last=False)
+
+
+def _spill_session(score_id: str, entry: dict) -> bool:
+	"""Move a session's page images to disk and drop its encoded-image cache.
+	Returns False (session untouched) if the pages couldn't be written."""
+	try:
+		entry['score'].spill_pages(_spill_path(score_id))
+	except OSError:
+		logger.exception("Failed to spill session %s", score_id)
+		return False
+	with _store_lock:
+		entry['spilled'] = True
+		entry.pop('image_cache', None)
+	return True
+
+
+def _spill_path(score_id: str) -> str:
+	"""Directory for a session's spilled pages, inside this process's spill root."""
+	global _spill_root
+	with _spill_root_lock:
+		if _spill_root is None:
+			os.makedirs(SPILL_DIR, exist_ok=True)
+			_spill_root = tempfile.mkdtemp(prefix='divisi-partifi-sessions-', dir=SPILL_DIR)
+			atexit.register(shutil.rmtree, _spill_root, ignore_errors=True)
+	return os.path.join(_spill_root, score_id)
+
+
+def _remove_session_files(score_id: str):
+	"""Delete a session's spilled pages and any part PDFs written for
+	X-Accel-Redirect downloads."""
+	if _spill_root is not None:
+		shutil.rmtree(os.path.join(_spill_root, score_id), ignore_errors=True)
+	shutil.rmtree(os.path.join(PARTS_DIR, score_id), ignore_errors=True)
 
 
 # --- Error handlers ---
@@ -68,17 +245,24 @@ def internal_error(e):
 	return jsonify({"error": "Internal server error"}), 500
 
 
+# Canonical str(uuid4()) form: the only shape score IDs are ever issued in
+_SCORE_ID_RE = re.compile(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}')
+
+
 def _validate_score_id(score_id: str) -> dict:
 	"""Validate UUID format and look up score. Aborts with 400/404 on failure.
 	Refreshes the session TTL on successful access."""
-	try:
-		uuid.UUID(score_id)
-	except ValueError:
+	if not _SCORE_ID_RE.fullmatch(score_id):
 		abort(400, description="Invalid score ID format")
-	entry = scores.get(score_id)
+	with _store_lock:
+		entry = scores.get(score_id) or _spilling.get(score_id)
+		if entry:
+			entry['created_at'] = time.time()
+			entry['hits'] = entry.get('hits', 0) + 1
+			if score_id in scores:
+				scores.move_to_end(score_id)
 	if not entry:
 		abort(404, description="Score not found")
-	entry['created_at'] = time.time()
 	return entry
 
 
@@ -86,79 +270,140 @@ def _validate_score_id(score_id: str) -> dict:
 
 @app.route('/api/upload', methods=['POST'])
 def upload_score():
-	"""Accept a PDF upload, extract pages, return metadata."""
-	if 'file' not in request.files:
-		abort(400, description="No file provided")
-
-	file = request.files['file']
-	if not file.filename or not file.filename.lower().endswith('.pdf'):
+	"""Accept a PDF upload, extract pages, return metadata.
+
+	Two request shapes are accepted:
+	  - raw body (``Content-Type: application/pdf``), filename in the
+	    ``X-Filename`` header (URL-encoded), title/composer as query args.
+	    The body is read straight into memory without multipart parsing.
+	  - ``multipart/form-data`` with a ``file`` part and optional
+	    ``title``/``composer`` fields.
+	"""
+	if request.mimetype in RAW_UPLOAD_MIMETYPES:
+		filename = unquote(request.headers.get('X-Filename', ''))
+		source = request.stream  # size-limited by MAX_CONTENT_LENGTH
+		fields = request.args
+	else:
+		if 'file' not in request.files:
+			abort(400, description="No file provided")
+		file = request.files['file']
+		filename = file.filename
+		source = file.stream
+		fields = request.form
+
+	if not filename or not filename.lower().endswith('.pdf'):
 		abort(400, description="Only PDF files are accepted")
 
-	title = request.form.get('title') or os.path.splitext(file.filename)[0]
-	composer = request.form.get('composer') or "Unknown"
+	title = fields.get('title') or os.path.splitext(filename)[0]
+	composer = fields.get('composer') or "Unknown"
 
 	score_id = str(uuid.uuid4())
-	pdf_path = os.path.join(TMP_DIR, f"{score_id}.pdf")
 
 	try:
-		os.makedirs(TMP_DIR, exist_ok=True)
-		file.save(pdf_path)
-
+		# PyMuPDF opens the bytes directly — no temp file written and re-read
+		pdf_bytes = source.read()
 		score = Score(
-			path=pdf_path,
+			stream=pdf_bytes,
 			title=title,
 			composer=composer,
 			keep_temp_files=False
 		)
 		score._extract_pages(dpi=300)
+	except RequestEntityTooLarge:
+		raise  # body exceeded MAX_CONTENT_LENGTH mid-stream → 413
 	except Exception as e:
 		logger.exception("PDF processing failed for upload")
-		if os.path.exists(pdf_path):
-			os.remove(pdf_path)
 		abort(500, description="Failed to process the uploaded PDF")
-	finally:
-		# Clean up uploaded PDF — pages are already extracted into memory
-		if os.path.exists(pdf_path):
-			os.remove(pdf_path)
 
 	pages_meta = []
 	for i, page in enumerate(score.pages):
-		h, w = page.img.shape[:2]
-		pages_meta.append({"page_num": i, "width": w, "height": h})
-
-	_evict_expired_sessions()
-
-	scores[score_id] = {
-		"score": score,
-		"created_at": time.time(),
-		"metadata": {
-			"score_id": score_id,
-			"title": score.title,
-			"composer": score.composer,
-			"page_count": len(score.pages),
-			"pages": pages_meta,
-		}
+		pages_meta.append({"page_num": i, "width": page.width, "height": page.height})
+
+	metadata = {
+		"score_id": score_id,
+		"title": score.title,
+		"composer": score.composer,
+		"page_count": len(score.pages),
+		"pages": pages_meta,
 	}
+	with _store_lock:
+		to_spill, removed = _evict_expired_sessions(
+			incoming_bytes=sum(page.img.nbytes for page in score.pages)
+		)
+		scores[score_id] = {
+			"score": score,
+			"created_at": time.time(),
+			"hits": 0,
+			"metadata": metadata,
+		}
+	_finish_eviction(to_spill, removed)
 
-	return jsonify(scores[score_id]["metadata"]), 201
+	return jsonify(metadata), 201
 
 
 @app.route('/api/scores/<score_id>/pages/<int:page_num>', methods=['GET'])
 def serve_page(score_id: str, page_num: int):
-	"""Serve an extracted page as a PNG image."""
+	"""Serve an extracted page as a PNG image, or WebP if the client's
+	Accept header lists it.
+
+	Optional query arg ``width`` downscales the image for display (rounded
+	up to a multiple of DISPLAY_WIDTH_STEP, never above the page width).
+	Coordinates sent back to the API stay in full-resolution page pixels.
+	"""
 	entry = _validate_score_id(score_id)
 	score = entry["score"]
 
 	if page_num < 0 or page_num >= len(score.pages):
 		abort(404, description=f"Page {page_num} not found")
 
+	width = request.args.get('width', type=int)
+	if width is not None:
+		if width <= 0:
+			abort(400, description="width must be a positive integer")
+		width = -(-width // DISPLAY_WIDTH_STEP) * DISPLAY_WIDTH_STEP
+		if width >= score.pages[page_num].width:
+			width = None
+
+	webp = SERVE_WEBP and 'image/webp' in request.headers.get('Accept', '')
+	mimetype = 'image/webp' if webp else 'image/png'
 	try:
-		png_bytes = score.pages[page_num].to_png_bytes()
+		img_bytes, etag = _cached_page_image(entry, page_num, mimetype, width)
 	except PageError as e:
 		logger.exception("Failed to encode page %d", page_num)
 		abort(500, description="Failed to encode page image")
 
-	return send_file(io.BytesIO(png_bytes), mimetype='image/png')
+	# conditional=True answers a matching If-None-Match with 304
+	response = send_file(io.BytesIO(img_bytes), mimetype=mimetype, etag=etag, conditional=True)
+	response.vary.add('Accept')
+	return response
+
+
+def _cached_page_image(entry: dict, page_num: int, mimetype: str, width: int = None) -> tuple[bytes, str]:
+	"""Return (image_bytes, etag) for a page in ``mimetype`` (image/png or
+	image/webp) at ``width`` (None = full size), encoding each variant at
+	most once.
+
+	Encoded pages live in a small per-session LRU (PAGE_IMAGE_CACHE_SIZE).
+	Page images never change after upload, so entries don't need
+	invalidating — only evicting.
+	"""
+	with _store_lock:
+		cache = entry.setdefault("image_cache", OrderedDict())
+		key = (page_num, mimetype, width)
+		if key in cache:
+			cache.move_to_end(key)
+			return cache[key]
+	page = entry["score"].pages[page_num]
+	if mimetype == 'image/webp':
+		img_bytes = page.to_webp_bytes(PAGE_WEBP_QUALITY, width=width)
+	else:
+		img_bytes = page.to_png_bytes(width=width)
+	etag = hashlib.blake2b(img_bytes, digest_size=16).hexdigest()
+	with _store_lock:
+		cache[key] = (img_bytes, etag)
+		if len(cache) > PAGE_IMAGE_CACHE_SIZE:
+			cache.popitem(last=False)
+	return img_bytes, etag
 
 
 # --- Staff detection helpers ---
@@ -189,15 +434,12 @@ def _compute_typical_margin(systems: list[list[np.ndarray]]) -> int:
 	then returns the median. This is the natural "breathing room" around
 	each staff that boundary dividers should replicate.
 	"""
-	half_gaps: list[int] = []
-	for system in systems:
-		for i in range(len(system) - 1):
-			bottom = int(system[i][-1])
-			top = int(system[i + 1][0])
-			half_gaps.append((top - bottom) // 2)
-	if not half_gaps:
+	# Pair every stave's bottom line with the next stave's top line
+	bottoms = np.fromiter((s[-1] for system in systems for s in system[:-1]), dtype=np.int64)
+	tops = np.fromiter((s[0] for system in systems for s in system[1:]), dtype=np.int64)
+	if not len(tops):
 		return 50  # fallback for single-stave systems
-	return int(np.median(half_gaps))
+	return int(np.median((tops - bottoms) // 2))
 
 
 def staves_to_dividers(
@@ -266,11 +508,13 @@ def staves_to_dividers(
 	return dividers, system_flags
 
 
-@app.route('/api/scores/<score_id>/pages/<int:page_num>/detect', methods=['POST'])
+@app.route('/api/scores/<score_id>/pages/<int:page_num>/detect', methods=['GET'])
 def detect_page_staves(score_id: str, page_num: int):
 	"""Run staff detection on a page and return tentative divider positions.
 
-	No request body required.
+	A GET, so the browser can cache the result: it's sent with an ETag and
+	``Cache-Control: no-cache``, and a revalidation whose If-None-Match
+	still matches gets an empty 304.
 
 	Returns dividers and system flags in backend-pixel space (300 DPI).
 	The frontend is responsible for scaling to display pixels using the
@@ -282,21 +526,25 @@ def detect_page_staves(score_id: str, page_num: int):
 	if page_num < 0 or page_num >= len(score.pages):
 		abort(404, description=f"Page {page_num} not found")
 
-	# Return cached result if available
+	# Detection is deterministic per page, so the result is cached with an
+	# ETag over its content; a 304 skips re-serializing the dividers.
 	cache = entry.setdefault("detection_cache", {})
-	if page_num in cache:
-		cached = cache[page_num]
-		return jsonify({
-			"confidence": cached["confidence"],
-			"reasons": cached["reasons"],
-			"stave_count": cached["stave_count"],
-			"system_count": cached["system_count"],
-			"dividers": cached["dividers"],
-			"system_flags": cached["system_flags"],
-		})
-
-	page_img = score.pages[page_num].img
-	img_height, img_width = page_img.shape[:2]
+	if page_num not in cache:
+		cache[page_num] = _detect_page(score.pages[page_num].img, page_num)
+	result, etag = cache[page_num]
+
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+	else:
+		response = jsonify(result)
+	response.set_etag(etag)
+	response.cache_control.no_cache = True
+	return response
+
+
+def _detect_page(page_img: np.ndarray, page_num: int) -> tuple[dict, str]:
+	"""Run staff detection on one page image. Returns (result, etag)."""
+	img_height = page_img.shape[0]
 
 	try:
 		result = detect_staves(page_img)
@@ -305,29 +553,18 @@ def detect_page_staves(score_id: str, page_num: int):
 		abort(500, description="Staff detection failed")
 
 	systems = result["systems"]
-	staves = result["staves"]
-	confidence = result["confidence"]
-	reasons = result["reasons"]
-
 	dividers, sys_flags = staves_to_dividers(systems, img_height)
 
-	cache[page_num] = {
-		"confidence": confidence,
-		"reasons": reasons,
-		"stave_count": len(staves),
+	detection = {
+		"confidence": result["confidence"],
+		"reasons": result["reasons"],
+		"stave_count": len(result["staves"]),
 		"system_count": len(systems),
 		"dividers": dividers,
 		"system_flags": sys_flags,
 	}
-
-	return jsonify({
-		"confidence": confidence,
-		"reasons": reasons,
-		"stave_count": len(staves),
-		"system_count": len(systems),
-		"dividers": dividers,
-		"system_flags": sys_flags,
-	})
+	digest = hashlib.blake2b(repr(sorted(detection.items())).encode(), digest_size=16)
+	return detection, digest.hexdigest()
 
 
 # --- Partition helpers ---
@@ -395,23 +632,60 @@ def _resolve_strip_names_globally(all_real_strips: dict[int, list[dict]]) -> Non
 		_fill_page_with_sequence(real_strips, known)
 
 
-def _group_strips_by_system(real_strips: list[dict]) -> list[list[dict]]:
-	"""Group a page's real strips into systems based on is_system_start flags."""
-	systems: list[list[dict]] = []
-	for strip in real_strips:
-		if strip['is_system_start'] or not systems:
-			systems.append([])
-		systems[-1].append(strip)
-	return systems
+def _system_strip_ranges(real_strips: list[dict]) -> list[tuple[int, int]]:
+	"""Split a page's real strips into systems based on is_system_start flags.
+
+	Returns half-open (start, end) index ranges into ``real_strips``; since
+	Phase 3 creates one staff per strip in order, the same ranges slice
+	``page.staves``.
+	"""
+	ranges: list[tuple[int, int]] = []
+	start = 0
+	for i, strip in enumerate(real_strips):
+		if strip['is_system_start'] and i > start:
+			ranges.append((start, i))
+			start = i
+	if start < len(real_strips):
+		ranges.append((start, len(real_strips)))
+	return ranges
 
 
 def _convert_rect_to_backend(rect: dict, scale: float, img_width: int, img_height: int) -> dict:
 	"""Convert a display-pixel rect to backend-pixel rect, clamped to image bounds."""
-	bx = min(max(round(rect['x'] / scale), 0), img_width)
-	by = min(max(round(rect['y'] / scale), 0), img_height)
-	bw = min(round(rect['w'] / scale), img_width - bx)
-	bh = min(round(rect['h'] / scale), img_height - by)
-	return {'x': bx, 'y': by, 'w': bw, 'h': bh}
+	return _convert_rects_to_backend([rect], scale, img_width, img_height)[0]
+
+
+def _convert_rects_to_backend(rects: list[dict], scale: float, img_width: int, img_height: int) -> list[dict]:
+	"""Convert display-pixel rects on one page to backend-pixel rects in a
+	single NumPy pass. Origins are clamped to the image; sizes are capped
+	at the distance to the far edge (and may come out <= 0)."""
+	try:
+		display = np.array(
+			[[r['x'], r['y'], r['w'], r['h']] for r in rects], dtype=np.float64
+		).reshape(-1, 4)
+	except (KeyError, TypeError, ValueError):
+		abort(400, description="Rects must have numeric x, y, w and h")
+	if not np.isfinite(display).all():
+		abort(400, description="Rects must have finite x, y, w and h")
+	rounded = np.rint(display / scale)
+	bounds = np.array([img_width, img_height], dtype=np.float64)
+	origin = np.clip(rounded[:, :2], 0, bounds)
+	size = np.minimum(rounded[:, 2:], bounds - origin)
+	backend = np.hstack([origin, size]).astype(np.int64).tolist()
+	return [{'x': x, 'y': y, 'w': w, 'h': h} for x, y, w, h in backend]
+
+
+def _crop_view(img: np.ndarray, br: dict) -> np.ndarray:
+	"""Read-only view of a backend-pixel rect of a page image.
+
+	Header and marking crops are only ever read (scaled, then pasted), so
+	they share the page's memory rather than copying it; the page lives as
+	long as the session. The view is read-only so an accidental in-place
+	edit raises instead of corrupting the source page.
+	"""
+	view = img[br['y']:br['y'] + br['h'], br['x']:br['x'] + br['w']]
+	view.flags.writeable = False
+	return view
 
 
 @app.route('/api/scores/<score_id>/partition', methods=['POST'])
@@ -448,7 +722,7 @@ def partition_score(score_id: str):
 			abort(400, description=f"Page {page_key} does not exist")
 
 		page = score.pages[page_idx]
-		img_height, img_width = page.img.shape[:2]
+		img_height, img_width = page.height, page.width
 		scale = display_width / img_width
 
 		dividers = page_data.get('dividers', [])
@@ -461,26 +735,36 @@ def partition_score(score_id: str):
 			abort(400, description=f"Page {page_key}: strip_names length ({len(strip_names)}) != dividers-1 ({len(dividers) - 1})")
 
 		# Convert display pixels → backend pixels, clamped to image bounds
-		backend_dividers = [
-			min(max(round(d / scale), 0), img_height) for d in dividers
-		]
-
-		# Extract real strips (skip dead-space gaps where next divider is a system divider)
-		real_strips = []
-		for j in range(len(backend_dividers) - 1):
-			if system_flags[j + 1]:
-				continue  # dead space: gap before a system divider
-			y = backend_dividers[j]
-			h = backend_dividers[j + 1] - y
-			if h <= 0:
-				continue
-			name = strip_names[j].strip() if strip_names[j] else ""
-			real_strips.append({
+		try:
+			display_dividers = np.asarray(dividers, dtype=np.float64)
+		except (TypeError, ValueError):
+			abort(400, description=f"Page {page_key}: dividers must be numbers")
+		if display_dividers.ndim != 1 or not np.isfinite(display_dividers).all():
+			abort(400, description=f"Page {page_key}: dividers must be finite numbers")
+		backend_dividers = np.clip(
+			np.rint(display_dividers / scale), 0, img_height
+		).astype(np.int64)
+		try:
+			flags = np.asarray(system_flags, dtype=bool)
+		except (TypeError, ValueError):
+			abort(400, description=f"Page {page_key}: system_flags must be booleans")
+
+		# Extract real strips in one pass: skip dead-space gaps (the next
+		# divider is a system divider) and empty bands
+		ys = backend_dividers[:-1]
+		hs = np.diff(backend_dividers)
+		keep = np.flatnonzero((hs > 0) & ~flags[1:])
+		real_strips = [
+			{
 				'y': y,
 				'h': h,
-				'name': name,
-				'is_system_start': bool(system_flags[j]),
-			})
+				'name': strip_names[j].strip() if strip_names[j] else "",
+				'is_system_start': is_start,
+			}
+			for j, y, h, is_start in zip(
+				keep.tolist(), ys[keep].tolist(), hs[keep].tolist(), flags[keep].tolist()
+			)
+		]
 
 		all_real_strips[page_idx] = real_strips
 
@@ -517,7 +801,7 @@ def partition_score(score_id: str):
 					h=strip['h'],
 					page=page,
 				)
-				staff.source_page_width = page.img.shape[1]
+				staff.source_page_width = page.width
 				page.staves.append(staff)
 				part.staves.append(staff)
 	except StaffError as e:
@@ -538,71 +822,65 @@ def partition_score(score_id: str):
 		h_scale = display_width / h_width
 		br = _convert_rect_to_backend(header_data, h_scale, h_width, h_height)
 		if br['w'] > 0 and br['h'] > 0:
-			header_crop = h_img[br['y']:br['y'] + br['h'], br['x']:br['x'] + br['w']].copy()
+			header_crop = _crop_view(h_img, br)
 			for part in parts_list:
 				part.header_img = header_crop
 				part.header_source_width = h_width
 
 	# --- Phase 3c: Attach score markings (tempo, etc.) to staves ---
 	markings_data = data.get('markings', [])
+	markings_by_page: dict[int, list[dict]] = {}
 	for ann_rect in markings_data:
 		ann_page_idx = ann_rect.get('page', 0)
-		if ann_page_idx < 0 or ann_page_idx >= len(score.pages):
-			continue
-		page = score.pages[ann_page_idx]
-		ann_img = page.img
-		ann_h, ann_w = ann_img.shape[:2]
-		ann_scale = display_width / ann_w
+		if ann_page_idx in all_real_strips and 0 <= ann_page_idx < len(score.pages):
+			markings_by_page.setdefault(ann_page_idx, []).append(ann_rect)
 
-		br = _convert_rect_to_backend(ann_rect, ann_scale, ann_w, ann_h)
-		if br['w'] <= 0 or br['h'] <= 0:
-			continue
-		crop = ann_img[br['y']:br['y'] + br['h'], br['x']:br['x'] + br['w']].copy()
-
-		# Find which system this marking belongs to
-		if ann_page_idx not in all_real_strips:
-			continue
-		systems = _group_strips_by_system(all_real_strips[ann_page_idx])
-		ann_y_center = br['y'] + br['h'] // 2
-
-		target_system = None
-		for system in systems:
-			sys_bottom = system[-1]['y'] + system[-1]['h']
-			if ann_y_center <= sys_bottom:
-				target_system = system
-				break
-		if target_system is None:
-			target_system = systems[-1] if systems else None
-		if target_system is None:
+	for ann_page_idx, page_markings in markings_by_page.items():
+		page = score.pages[ann_page_idx]
+		real_strips = all_real_strips[ann_page_idx]
+		system_ranges = _system_strip_ranges(real_strips)
+		if not system_ranges:
 			continue
-
-		first_strip = target_system[0]
-		inside_first = (
-			br['y'] >= first_strip['y']
-			and br['y'] + br['h'] <= first_strip['y'] + first_strip['h']
-		)
-		y_offset = br['y'] - first_strip['y']
-
-		# Attach to every staff in this system
-		first_strip_id = id(first_strip)
-		sys_strip_set = {id(s) for s in target_system}
-		strip_idx = 0
-		for staff in page.staves:
-			if strip_idx < len(all_real_strips[ann_page_idx]):
-				strip = all_real_strips[ann_page_idx][strip_idx]
-				if id(strip) in sys_strip_set:
-					staff.markings.append({
-						'img': crop,
-						'x_pos': br['x'],
-						'y_offset': y_offset,
-						'inside_first': inside_first,
-						'is_first_in_system': id(strip) == first_strip_id,
-					})
-				strip_idx += 1
+		ann_scale = display_width / page.width
+		rects = _convert_rects_to_backend(page_markings, ann_scale, page.width, page.height)
+
+		# Each marking belongs to the first system whose bottom is at or
+		# below its centre (else the last system). The running max of the
+		# bottoms is sorted, so one searchsorted finds that system for all
+		# markings whatever the strip order.
+		bottoms = np.maximum.accumulate([
+			real_strips[end - 1]['y'] + real_strips[end - 1]['h'] for _, end in system_ranges
+		])
+		centers = [br['y'] + br['h'] // 2 for br in rects]
+		targets = np.minimum(np.searchsorted(bottoms, centers), len(system_ranges) - 1).tolist()
+
+		for br, target in zip(rects, targets):
+			if br['w'] <= 0 or br['h'] <= 0:
+				continue
+			crop = _crop_view(page.img, br)
+			start, end = system_ranges[target]
+
+			first_strip = real_strips[start]
+			inside_first = (
+				br['y'] >= first_strip['y']
+				and br['y'] + br['h'] <= first_strip['y'] + first_strip['h']
+			)
+			y_offset = br['y'] - first_strip['y']
+
+			# Attach to every staff in this system
+			for k, staff in enumerate(page.staves[start:end]):
+				staff.markings.append({
+					'img': crop,
+					'x_pos': br['x'],
+					'y_offset': y_offset,
+					'inside_first': inside_first,
+					'is_first_in_system': k == 0,
+				})
 
 	# --- Phase 4: Compute preview metadata (no rendering yet) ---
 	score.parts = parts_list
 	score.parts_dict = parts_dict
+	entry["partition_rev"] = entry.get("partition_rev", 0) + 1  # invalidates stave ETags
 
 	preview_parts = []
 	try:
@@ -639,19 +917,29 @@ def serve_stave_image(score_id: str, part_name: str, stave_index: int):
 	# Ensure layout has been computed (preview_metadata sets this up)
 	if not hasattr(part, 'available_width') or part.available_width == 0:
 		part.dpi = 300
-		if part.staves:
-			part.width = max(s.img.shape[1] for s in part.staves)
 		part._layout(dpi=part.dpi)
 
-	staff = part.staves[stave_index]
-	scaled = part._adapt_staff(staff)
+	# Stave images only change when the score is re-partitioned or the
+	# output width changes, so the preview grid can revalidate with a 304
+	# before anything is scaled or encoded.
+	tag = f"{score_id}/{entry.get('partition_rev', 0)}/{part_name}/{stave_index}/{part.available_width}"
+	etag = hashlib.blake2b(tag.encode(), digest_size=16).hexdigest()
+	if request.if_none_match.contains(etag):
+		response = Response(status=304)
+		response.set_etag(etag)
+		return response
+
+	scaled = part._adapt_staves()[stave_index]
 
 	success, buf = cv2.imencode('.png', scaled)
 	if not success:
 		logger.error("Failed to encode stave image for part '%s', index %d", part_name, stave_index)
 		abort(500, description="Failed to encode stave image")
 
-	return send_file(io.BytesIO(buf.tobytes()), mimetype='image/png')
+	# The encoded buffer goes out as the body directly, no BytesIO file wrapper
+	response = Response(buf.tobytes(), mimetype='image/png')
+	response.set_etag(etag)
+	return response
 
 
 @app.route('/api/scores/<score_id>/generate', methods=['POST'])
@@ -681,28 +969,45 @@ def generate_parts(score_id: str):
 
 	parts_config = data['parts']
 
+	# Validate every part before rendering any, so abort() runs on the
+	# request thread and a bad config doesn't leave half the parts rendered.
+	jobs = []
+	for part in score.parts:
+		cfg = parts_config.get(part.name, {})
+
+		spacing_mm = cfg.get('spacing_mm')
+		if spacing_mm is not None:
+			if not (2 <= spacing_mm <= 30):
+				abort(400, description=f"spacing_mm must be 2–30 for '{part.name}'")
+
+		offsets = cfg.get('offsets')
+		if offsets is not None:
+			if len(offsets) != len(part.staves):
+				abort(400, description=(
+					f"offsets length ({len(offsets)}) != stave count "
+					f"({len(part.staves)}) for '{part.name}'"
+				))
+		jobs.append((part, spacing_mm, offsets, cfg.get('page_breaks_after')))
+
+	for part, spacing_mm, _, _ in jobs:
+		part.pages = []  # reset any previous render
+		if spacing_mm is not None:
+			part._custom_spacing_mm = spacing_mm
+
+	def render(job):
+		part, _, offsets, page_breaks_after = job
+		part.process(offsets=offsets, page_breaks_after=page_breaks_after)
+
+	# Parts are independent and the heavy work (resize, paste) runs in
+	# OpenCV/NumPy with the GIL released, so threads scale across parts.
+	jobs = [job for job in jobs if job[0].staves]
 	try:
-		for part in score.parts:
-			part.pages = []  # reset any previous render
-			cfg = parts_config.get(part.name, {})
-
-			spacing_mm = cfg.get('spacing_mm')
-			if spacing_mm is not None:
-				if not (2 <= spacing_mm <= 30):
-					abort(400, description=f"spacing_mm must be 2–30 for '{part.name}'")
-				part._custom_spacing_mm = spacing_mm
-
-			offsets = cfg.get('offsets')
-			if offsets is not None:
-				if len(offsets) != len(part.staves):
-					abort(400, description=(
-						f"offsets length ({len(offsets)}) != stave count "
-						f"({len(part.staves)}) for '{part.name}'"
-					))
-			page_breaks_after = cfg.get('page_breaks_after')
-
-			if part.staves:
-				part.process(offsets=offsets, page_breaks_after=page_breaks_after)
+		if len(jobs) > 1:
+			with ThreadPoolExecutor(max_workers=min(MAX_RENDER_THREADS, len(jobs))) as pool:
+				list(pool.map(render, jobs))
+		else:
+			for job in jobs:
+				render(job)
 	except PartError as e:
 		logger.exception("Part processing failed during generate")
 		abort(500, description="Part processing failed")
@@ -740,27 +1045,42 @@ def download_part(score_id: str, part_name: str):
 	if not part.pages:
 		abort(404, description=f"Part '{part_name}' has no output pages")
 
-	# Build a PDF from the part's output page images using PyMuPDF
+	# Build a PDF from the part's output page images using PyMuPDF. Each page
+	# is handed over as a raw grayscale Pixmap and flate-compressed when the
+	# document is written: lossless, and far smaller than a q92 JPEG for
+	# mostly-white score pages, so no per-page JPEG encode is needed.
 	pdf_doc = fitz.open()
 	for page_img in part.pages:
-		success, jpg_buf = cv2.imencode('.jpg', page_img, [cv2.IMWRITE_JPEG_QUALITY, 92])
-		if not success:
-			logger.error("Failed to encode page image for part '%s'", part_name)
-			abort(500, description="Failed to encode page image")
-
-		img_bytes = jpg_buf.tobytes()
-		# Create a page matching the image dimensions (in points: 72 DPI)
 		h_px, w_px = page_img.shape[:2]
+		pixmap = fitz.Pixmap(fitz.csGRAY, w_px, h_px, np.ascontiguousarray(page_img, dtype=np.uint8).tobytes(), 0)
+		# Create a page matching the image dimensions (in points: 72 DPI)
 		w_pt = w_px * 72 / part.dpi
 		h_pt = h_px * 72 / part.dpi
 		pdf_page = pdf_doc.new_page(width=w_pt, height=h_pt)
-		pdf_page.insert_image(fitz.Rect(0, 0, w_pt, h_pt), stream=img_bytes)
-
-	pdf_bytes = pdf_doc.tobytes()
+		pdf_page.insert_image(fitz.Rect(0, 0, w_pt, h_pt), pixmap=pixmap)
+
+	if ACCEL_REDIRECT_PREFIX:
+		# Let the proxy serve the file so a slow client doesn't hold a worker.
+		# The file is overwritten on each download and removed with the session.
+		part_dir = os.path.join(PARTS_DIR, score_id)
+		os.makedirs(part_dir, exist_ok=True)
+		pdf_doc.save(os.path.join(part_dir, f"{part_name}.pdf"), **PDF_SAVE_OPTIONS)
+		pdf_doc.close()
+		response = Response(mimetype='application/pdf')
+		response.headers['X-Accel-Redirect'] = f"{ACCEL_REDIRECT_PREFIX}/{score_id}/{quote(part_name)}.pdf"
+		response.headers.set('Content-Disposition', 'attachment', filename=f"{part_name}.pdf")
+		return response
+
+	# Save straight into the buffer send_file streams from, rather than
+	# tobytes() followed by a BytesIO wrapper. (PyMuPDF's save() writes to
+	# BytesIO-like objects only; a SpooledTemporaryFile is rejected.)
+	pdf_file = io.BytesIO()
+	pdf_doc.save(pdf_file, **PDF_SAVE_OPTIONS)
 	pdf_doc.close()
+	pdf_file.seek(0)
 
 	return send_file(
-		io.BytesIO(pdf_bytes),
+		pdf_file,
 		mimetype='application/pdf',
 		as_attachment=True,
 		download_name=f"{part_name}.pdf"
@@ -769,6 +1089,7 @@ def download_part(score_id: str, part_name: str):
 
 if __name__ == '__main__':
 	os.makedirs(TMP_DIR, exist_ok=True)
-	app.run(debug=os.getenv('FLASK_DEBUG', 'true').lower() == 'true', port=5000) # TODO: change to false in production
+	# Development only; production runs wsgi:app under gunicorn
+	app.run(debug=os.getenv('FLASK_DEBUG', 'true').lower() == 'true', port=5000)
 
 	
@@ -8,18 +8,21 @@ Pipeline:
     1. Grayscale conversion
     2. Canny edge detection (adaptive thresholds)
     3. Horizontal dilation to bridge broken staff lines
-    4. HoughLines transform
+    4. HoughLines transform (near-horizontal/vertical angles only)
     5. Filter by angle + deduplicate
 """
 
+import bisect
+import hashlib
+import os
 import sys
+from collections import OrderedDict
 
 import cv2 as cv
 import numpy as np
 
-from .pdf import load_pdf_page
-
 ANGLE_THRESHOLD = np.pi / 180 * 2  # 2 degrees tolerance
+THETA_STEP = np.pi / 180  # Hough accumulator angle resolution
 
 # Reference image: music.png (732x980) — tuned parameters for this resolution
 REF_WIDTH = 732
@@ -28,7 +31,23 @@ REF_CANNY_LOW = 20
 REF_CANNY_HIGH = 80
 REF_HOUGH_THRESHOLD = 450
 DILATE_KERNEL_W = 5  # Fixed — gap bridging doesn't depend on resolution
+_DILATE_KERNEL = cv.getStructuringElement(cv.MORPH_RECT, (DILATE_KERNEL_W, 1))
 REF_DEDUP_RHO = 20
+# Images wider than this multiple of REF_WIDTH are downscaled to REF_WIDTH
+# before Canny/Hough: staff lines survive at that size, and the Hough
+# accumulator and edge pass shrink with the pixel count.
+DOWNSCALE_MIN_RATIO = 1.5
+# PDF pages are rendered at no more than the largest width analyzed without
+# downscaling, instead of at 300 DPI only to be shrunk again.
+PDF_TARGET_LONG_EDGE = int(REF_WIDTH * DOWNSCALE_MIN_RATIO)
+
+# Edges + raw Hough lines for recently seen images, so re-running detection
+# on the same page (tuning, re-partitioning) skips Canny and HoughLines.
+# Files are keyed by identity and also keep their loaded image, so a hit
+# skips loading too; arrays are keyed by content. Params depend only on
+# image size, which a content key includes.
+CACHE_SIZE = 16
+_cache: OrderedDict = OrderedDict()
 
 
 def estimate_params(img):
@@ -54,9 +73,9 @@ def estimate_params(img):
 
 
 def _to_grayscale(img):
-    """Convert BGR image to grayscale."""
+    """Convert BGR image to grayscale (gray input is returned as-is)."""
     if len(img.shape) == 2:
-        return img.copy()
+        return img
     return cv.cvtColor(img, cv.COLOR_BGR2GRAY)
 
 
@@ -64,45 +83,145 @@ def filter_by_angle(lines, target_angle, threshold=ANGLE_THRESHOLD, dedup_rho=20
     """Filter Hough lines by angle and deduplicate by rho coordinate."""
     if lines is None:
         return []
-    filtered = [line for line in lines if abs(line[0][1] - target_angle) % np.pi < threshold]
+    filtered = lines[np.abs(lines[:, 0, 1] - target_angle) % np.pi < threshold]
+    # Greedy in HoughLines' order (strongest first): a line is dropped if an
+    # already-kept line is within dedup_rho and threshold of it. Kept rhos
+    # stay sorted so each check only looks at the kept lines in the rho
+    # window, instead of scanning all of them.
     unique = []
+    kept_rhos = []
+    kept = []
     for line in filtered:
         rho, theta = line[0]
-        if not any(abs(rho - l[0][0]) < dedup_rho and abs(theta - l[0][1]) < threshold for l in unique):
+        lo = bisect.bisect_left(kept_rhos, rho - dedup_rho)
+        hi = bisect.bisect_right(kept_rhos, rho + dedup_rho)
+        if not any(abs(rho - l[0][0]) < dedup_rho and abs(theta - l[0][1]) < threshold for l in kept[lo:hi]):
             unique.append(line)
+            i = bisect.bisect_left(kept_rhos, rho)
+            kept_rhos.insert(i, rho)
+            kept.insert(i, line)
     return unique
 
 
+def _image_key(img):
+    """Content key for an array. The full-resolution pixels are hashed:
+    downscaling first would cost more than the hash it saves. SHA-1 runs
+    at about twice blake2b's speed here and only has to tell pages apart."""
+    digest = hashlib.sha1(np.ascontiguousarray(img).data, usedforsecurity=False).digest()
+    return digest, img.shape, img.dtype.str
+
+
+def _file_key(path, page_num):
+    """Identity key for a file (None if it can't be stat'ed — loading then
+    reports the error). A rewritten file gets a new mtime or size."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size, page_num
+
+
+def _edges_and_lines(img):
+    """Canny + dilation + HoughLines, on a downscaled copy for large images.
+
+    Returns (edges, lines, params). ``edges`` and ``params`` are at the
+    working resolution (``params["downscale"]`` is the factor applied);
+    line rhos are mapped back to ``img`` pixels. Results are shared through
+    the cache, so arrays are returned read-only.
+    """
+    gray = _to_grayscale(img)
+    downscale = 1.0
+    if gray.shape[1] > REF_WIDTH * DOWNSCALE_MIN_RATIO:
+        downscale = REF_WIDTH / gray.shape[1]
+        gray = cv.resize(gray, None, fx=downscale, fy=downscale, interpolation=cv.INTER_AREA)
+    params = estimate_params(gray)
+    params["downscale"] = downscale
+
+    edges = cv.Canny(gray, params["canny_low"], params["canny_high"], apertureSize=3)
+
+    # Dilate to connect broken/faint horizontal lines
+    edges = cv.dilate(edges, _DILATE_KERNEL, dst=edges, iterations=1)
+
+    lines = _hough_near_axes(edges, params["hough_threshold"])
+
+    if lines is not None and downscale != 1.0:
+        lines[:, 0, 0] /= downscale
+    # dedup_rho is applied to full-resolution rhos
+    params["dedup_rho"] = max(5, int(round(params["dedup_rho"] / downscale)))
+
+    edges.flags.writeable = False
+    if lines is not None:
+        lines.flags.writeable = False
+    return edges, lines, params
+
+
+def _hough_near_axes(edges, threshold):
+    """HoughLines restricted to the angle bins filter_by_angle can accept.
+
+    Only lines within ANGLE_THRESHOLD of horizontal or vertical are used,
+    so voting over the full 180 degrees throws most of the accumulator
+    away. Each window starts on a multiple of THETA_STEP, so the bins and
+    the vote order within them match a full-range run. Returns the two
+    windows' lines concatenated (horizontal first), or None.
+    """
+    found = []
+    for target in (np.pi / 2, 0):
+        min_theta = max(0, np.floor((target - ANGLE_THRESHOLD) / THETA_STEP)) * THETA_STEP
+        max_theta = np.ceil((target + ANGLE_THRESHOLD) / THETA_STEP) * THETA_STEP
+        lines = cv.HoughLines(edges, 1, THETA_STEP, threshold, None, 0, 0, min_theta, max_theta)
+        if lines is not None:
+            found.append(lines)
+    return np.concatenate(found) if found else None
+
+
+def _load_image(source, page_num):
+    """The image to analyze: an array as given, a PDF page, or an image file."""
+    if isinstance(source, np.ndarray):
+        return source
+    if source.lower().endswith(".pdf"):
+        from .pdf import load_pdf_page  # PyMuPDF only loads for PDF input
+        return load_pdf_page(
+            source, page_num, want_bgr=False, target_long_edge=PDF_TARGET_LONG_EDGE
+        )
+    # Only the grayscale is analyzed; plot_results expands it for drawing.
+    img = cv.imread(source, cv.IMREAD_GRAYSCALE)
+    if img is None:
+        raise FileNotFoundError(f"Could not load: {source}")
+    return img
+
+
 def detect_lines(source, page_num=0):
     """Run the Hough line detection pipeline.
 
     Args:
         source: file path (PNG/JPG/PDF) or a numpy array (BGR image).
-            If a PDF, ``page_num`` selects which page to analyze.
+            If a PDF, ``page_num`` selects which page to analyze. Files are
+            loaded as grayscale, since that is all the pipeline reads.
         page_num: 0-based page index (only used for PDFs).
 
     Returns a dict with:
-        img, edges, lines (raw), horizontal_lines, vertical_lines, params.
+        img, edges, lines (raw, near-axis angles only), horizontal_lines,
+        vertical_lines, params.
+    ``img`` (when loaded from a file), ``edges`` and ``lines`` may be
+    shared with earlier calls on the same image and are read-only.
     """
-    if isinstance(source, np.ndarray):
-        img = source
-    elif source.lower().endswith(".pdf"):
-        img = load_pdf_page(source, page_num)
+    from_file = not isinstance(source, np.ndarray)
+    key = _file_key(source, page_num) if from_file else _image_key(source)
+    if key in _cache:
+        _cache.move_to_end(key)
+        img, edges, lines, params = _cache[key]
+        if not from_file:
+            img = source
     else:
-        img = cv.imread(source)
-        if img is None:
-            raise FileNotFoundError(f"Could not load: {source}")
-
-    params = estimate_params(img)
-    gray = _to_grayscale(img)
-
-    edges = cv.Canny(gray, params["canny_low"], params["canny_high"], apertureSize=3)
-
-    # Dilate to connect broken/faint horizontal lines
-    kernel = cv.getStructuringElement(cv.MORPH_RECT, (params["dilate_kernel_w"], 1))
-    edges = cv.dilate(edges, kernel, iterations=1)
-
-    lines = cv.HoughLines(edges, 1, np.pi / 180, params["hough_threshold"])
+        img = _load_image(source, page_num)
+        edges, lines, params = _edges_and_lines(img)
+        if from_file:
+            img.flags.writeable = False
+        if key is not None:
+            _cache[key] = (img if from_file else None, edges, lines, params)
+            if len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+    params = dict(params)
 
     dedup_rho = params["dedup_rho"]
     horizontal_lines = filter_by_angle(lines, np.pi / 2, ANGLE_THRESHOLD, dedup_rho)
@@ -125,18 +244,18 @@ def detect_lines(source, page_num=0):
 def _draw_lines(img, lines, color):
     """Draw Hough lines on an image copy."""
     display = img.copy()
-    if lines is not None:
-        for line in lines:
-            rho, theta = line[0]
-            a = np.cos(theta)
-            b = np.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            x1 = int(x0 + 3000 * (-b))
-            y1 = int(y0 + 3000 * (a))
-            x2 = int(x0 - 3000 * (-b))
-            y2 = int(y0 - 3000 * (a))
-            cv.line(display, (x1, y1), (x2, y2), color, 2)
+    if lines is not None and len(lines):
+        rho, theta = np.asarray(lines).reshape(-1, 2).T
+        a = np.cos(theta)
+        b = np.sin(theta)
+        x0 = a * rho
+        y0 = b * rho
+        # (N, 2 endpoints, xy), truncated toward zero like int()
+        segments = np.stack([
+            np.stack([x0 - 3000 * b, y0 + 3000 * a], axis=1),
+            np.stack([x0 + 3000 * b, y0 - 3000 * a], axis=1),
+        ], axis=1).astype(np.int32)
+        cv.polylines(display, list(segments), False, color, 2)
     return display
 
 
@@ -151,8 +270,10 @@ def plot_results(result):
     params = result["params"]
 
     gray = _to_grayscale(img)
-    vert_img = _draw_lines(img.copy(), result["vertical_lines"], (0, 255, 0))
-    horiz_img = _draw_lines(img.copy(), result["horizontal_lines"], (255, 0, 0))
+    if len(img.shape) == 2:
+        img = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
+    vert_img = _draw_lines(img, result["vertical_lines"], (0, 255, 0))
+    horiz_img = _draw_lines(img, result["horizontal_lines"], (255, 0, 0))
 
     plt.figure(figsize=(30, 30))
     plt.subplot(141)
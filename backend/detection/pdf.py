@@ -1,33 +1,173 @@
 """Shared PDF page extraction for detection modules."""
 
+import math
+import os
+from collections import OrderedDict
+
 import cv2 as cv
 import fitz  # PyMuPDF
 import numpy as np
 
 DEFAULT_DPI = 300
+# Pages are rasterized in horizontal strips of this many pixel rows, each
+# converted straight into the output array, so peak memory holds one strip
+# of MuPDF samples rather than a full-page pixmap beside the result.
+STRIP_HEIGHT = 2048
+# Antialiasing near a clip edge differs from an unclipped render, so each
+# strip is rendered with this many spare rows either side, then trimmed.
+STRIP_OVERLAP = 64
+
+# Rendered pages keyed by (path, mtime, page, dpi, want_bgr), so running
+# several detectors on the same page rasterizes it once. Bounded by total
+# pixel bytes rather than entry count: a 300 DPI page is ~25 MB.
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+_cache: OrderedDict = OrderedDict()
+_cache_bytes = 0
+
+# Open documents keyed by (path, mtime), so rendering several pages of one
+# PDF parses its xref once.
+DOC_CACHE_SIZE = 4
+_docs: OrderedDict = OrderedDict()
 
+# Render matrices by DPI; only a handful of values are ever used.
+_matrices: dict = {}
 
-def load_pdf_page(pdf_path, page_num=0, dpi=DEFAULT_DPI):
+
+def load_pdf_page(pdf_path, page_num=0, dpi=DEFAULT_DPI, want_bgr=True,
+                  target_long_edge=None):
     """Extract a single page from a PDF as a BGR numpy array.
 
     Args:
         pdf_path: path to the PDF file.
         page_num: 0-based page index.
         dpi: rendering resolution (default 300).
+        want_bgr: return 3-channel BGR. The detectors convert to gray
+            first thing, so they pass False and MuPDF renders the page
+            straight to gray instead.
+        target_long_edge: if set, overrides ``dpi`` with the lowest
+            resolution whose longer side reaches this many pixels, for
+            detectors that work on a smaller canvas anyway.
 
     Returns:
-        BGR numpy array (3-channel, for consistency with cv.imread).
+        BGR numpy array (3-channel, for consistency with cv.imread), or a
+        2-D grayscale array when ``want_bgr`` is False. The array may be
+        shared with earlier calls and is read-only.
     """
+    global _cache_bytes
+    path = os.path.abspath(pdf_path)
+    mtime_ns = os.stat(path).st_mtime_ns
+    if target_long_edge is not None:
+        rect = _get_page(path, mtime_ns, page_num).rect
+        dpi = math.ceil(target_long_edge * 72 / max(rect.width, rect.height))
+    key = (path, mtime_ns, page_num, dpi, want_bgr)
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    img = _render_page(path, mtime_ns, page_num, dpi, want_bgr)
+    img.setflags(write=False)
+    if img.nbytes <= CACHE_MAX_BYTES:
+        _cache[key] = img
+        _cache_bytes += img.nbytes
+        while _cache_bytes > CACHE_MAX_BYTES:
+            _, old = _cache.popitem(last=False)
+            _cache_bytes -= old.nbytes
+    return img
+
+
+def flush_pdf_cache():
+    """Drop cached pages and close cached documents."""
+    global _cache_bytes
+    _cache.clear()
+    _cache_bytes = 0
+    while _docs:
+        _, doc = _docs.popitem()
+        doc.close()
+    fitz.TOOLS.store_shrink(100)
+
+
+def _get_doc(pdf_path, mtime_ns):
+    key = (pdf_path, mtime_ns)
+    if key in _docs:
+        _docs.move_to_end(key)
+        return _docs[key]
     doc = fitz.open(pdf_path)
-    if page_num < 0 or page_num >= len(doc):
+    _docs[key] = doc
+    if len(_docs) > DOC_CACHE_SIZE:
+        _, old = _docs.popitem(last=False)
+        old.close()
+        # MuPDF keeps decoded resources in a global store; release what the
+        # closed document was holding.
+        fitz.TOOLS.store_shrink(100)
+    return doc
+
+
+def _matrix(dpi):
+    if dpi not in _matrices:
+        _matrices[dpi] = fitz.Matrix(dpi / 72, dpi / 72)
+    return _matrices[dpi]
+
+
+def _get_page(pdf_path, mtime_ns, page_num):
+    doc = _get_doc(pdf_path, mtime_ns)
+    if page_num < 0 or page_num >= doc.page_count:
         raise ValueError(
-            f"Page {page_num} out of range (PDF has {len(doc)} pages)"
+            f"Page {page_num} out of range ({pdf_path} has {doc.page_count} pages)"
         )
-    pix = doc[page_num].get_pixmap(dpi=dpi, alpha=False)
-    img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+    return doc[page_num]
+
+
+def _render_page(pdf_path, mtime_ns, page_num, dpi, want_bgr):
+    page = _get_page(pdf_path, mtime_ns, page_num)
+    matrix = _matrix(dpi)
+    colorspace = fitz.csRGB if want_bgr else fitz.csGRAY
+    bbox = page.rect.transform(matrix).irect
+    if page.rotation or page.get_image_info():
+        # Clip rects are in unrotated page space, and MuPDF decodes and
+        # resamples only the clipped part of an image, so image pixels would
+        # depend on the strip. Render these pages in one go.
+        pix = page.get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
+        return _pixmap_to_array(pix, want_bgr)
+
+    out = None
+    inverse = ~matrix
+    for y0 in range(bbox.y0, bbox.y1, STRIP_HEIGHT):
+        y1 = min(y0 + STRIP_HEIGHT, bbox.y1)
+        top = max(bbox.y0, y0 - STRIP_OVERLAP)
+        bottom = min(bbox.y1, y1 + STRIP_OVERLAP)
+        clip = fitz.Rect(bbox.x0, top, bbox.x1, bottom).transform(inverse)
+        pix = page.get_pixmap(matrix=matrix, clip=clip, colorspace=colorspace, alpha=False)
+        if pix.h != bottom - top or pix.w != bbox.width:
+            # Rounding put the strip off by a pixel; render in one go.
+            pix = page.get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
+            return _pixmap_to_array(pix, want_bgr)
+        if out is None:
+            channels = 3 if pix.n == 1 and want_bgr else pix.n
+            shape = (bbox.height, bbox.width) + ((channels,) if channels > 1 else ())
+            out = np.empty(shape, dtype=np.uint8)
+        _pixmap_to_array(pix, want_bgr, out[y0 - bbox.y0:y1 - bbox.y0], row0=y0 - top)
+    return out
+
+
+def _pixmap_to_array(pix, want_bgr, dst=None, row0=0):
+    """Convert pixmap samples to BGR (or gray), writing into ``dst`` if given.
+
+    With ``dst``, only its height in rows is converted, starting at pixmap
+    row ``row0``.
+    """
+    # samples_mv is a zero-copy view of the pixmap's buffer (samples would
+    # copy the whole raster into a bytes object). Every branch below writes
+    # a new array, so nothing aliases the pixmap once it's released.
+    img = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.h, pix.w, pix.n)
+    if dst is not None:
+        img = img[row0:row0 + len(dst)]
+    if pix.n == 1 and want_bgr:
+        return cv.cvtColor(img, cv.COLOR_GRAY2BGR, dst=dst)
+    if pix.n == 3:
+        return cv.cvtColor(img, cv.COLOR_RGB2BGR, dst=dst)
     if pix.n == 1:
-        img = cv.cvtColor(img, cv.COLOR_GRAY2BGR)
-    elif pix.n == 3:
-        img = cv.cvtColor(img, cv.COLOR_RGB2BGR)
-    doc.close()
-    return img
+        img = img[:, :, 0]
+    if dst is None:
+        return img.copy()
+    dst[...] = img
+    return dst
@@ -0,0 +1,75 @@
+"""Unit tests for analyzer's part layout.
+
+Parts are laid out on A4 at 300 DPI (see PAGE_FORMATS): pages are
+3507 px tall, staves start at 590 px on the first page (top margin plus
+title area) and 236 px on later ones, must end by 3330 px, and are
+141 px (12 mm) apart.
+
+Run with:
+    cd backend && pytest tests/ -v
+"""
+
+import pytest
+
+from analyzer import Part
+
+FIRST_TOP = 590
+LATER_TOP = 236
+BOTTOM = 3330
+SPACING = 141
+
+
+@pytest.fixture
+def part():
+    part = Part("Violin", "Vln", [])
+    part._layout(dpi=300)
+    assert (part.margins['top'] + part.title_area, part.height - part.margins['bottom']) == (FIRST_TOP, BOTTOM)
+    return part
+
+
+def test_plan_fits_staves_on_one_page(part):
+    plan = part._plan_pages([400, 400, 400], [0, 0, 0], set())
+    assert plan == [[
+        (0, FIRST_TOP),
+        (1, FIRST_TOP + 400 + SPACING),
+        (2, FIRST_TOP + 2 * (400 + SPACING)),
+    ]]
+
+
+def test_plan_starts_a_new_page_on_overflow(part):
+    plan = part._plan_pages([1000] * 4, [0] * 4, set())
+    assert plan == [
+        [(0, FIRST_TOP), (1, FIRST_TOP + 1000 + SPACING)],
+        [(2, LATER_TOP), (3, LATER_TOP + 1000 + SPACING)],
+    ]
+
+
+def test_plan_adds_offsets_to_the_gap_above(part):
+    plan = part._plan_pages([400, 400], [0, 25], set())
+    assert plan == [[(0, FIRST_TOP), (1, FIRST_TOP + 400 + SPACING + 25)]]
+
+
+def test_plan_offset_can_push_a_stave_over(part):
+    # Fits with normal spacing (ends exactly at BOTTOM), not with one more pixel
+    height = (BOTTOM - FIRST_TOP - SPACING) // 2
+    heights = [height, BOTTOM - FIRST_TOP - SPACING - height]
+    assert len(part._plan_pages(heights, [0, 0], set())) == 1
+    assert part._plan_pages(heights, [0, 1], set()) == [[(0, FIRST_TOP)], [(1, LATER_TOP)]]
+
+
+def test_forced_break_justifies_the_page(part):
+    plan = part._plan_pages([400, 400, 400], [0, 0, 0], {1})
+    gap = BOTTOM - FIRST_TOP - 800
+    assert plan == [
+        [(0, FIRST_TOP), (1, FIRST_TOP + 400 + gap)],
+        [(2, LATER_TOP)],
+    ]
+
+
+def test_break_after_last_stave_adds_no_page(part):
+    plan = part._plan_pages([400, 400], [0, 0], {1})
+    assert len(plan) == 1
+
+
+def test_plan_of_no_staves_is_empty(part):
+    assert part._plan_pages([], [], set()) == []
@@ -0,0 +1,528 @@
+"""API tests for upload, page/stave serving, caching and session storage.
+
+Scores are small PDFs drawn in fixtures (four 5-line staves per page), so
+these tests don't depend on the sample files under img/.
+
+Run with:
+    cd backend && pytest tests/ -v
+"""
+
+import io
+import os
+import threading
+
+import cv2
+import numpy as np
+import pymupdf as fitz
+import pytest
+
+import analyzer
+import app as app_module
+
+# ---------------------------------------------------------------------------
+# Fixtures
+# ---------------------------------------------------------------------------
+
+PAGE_WIDTH_PT = 300  # 1250 px at 300 DPI
+PAGE_HEIGHT_PT = 400  # 1667 px
+
+
+def _make_score_pdf(page_count=2):
+    """A PDF whose pages each hold one system of four staves."""
+    doc = fitz.open()
+    for _ in range(page_count):
+        page = doc.new_page(width=PAGE_WIDTH_PT, height=PAGE_HEIGHT_PT)
+        for stave in range(4):
+            top = 40 + stave * 80
+            for line in range(5):
+                page.draw_line((20, top + line * 5), (280, top + line * 5), width=0.6)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    """Test client with an empty session store and spill files under tmp_path."""
+    monkeypatch.setattr(app_module, "SPILL_DIR", str(tmp_path / "sessions"))
+    monkeypatch.setattr(app_module, "_spill_root", None)
+    app_module.scores.clear()
+    app_module._spilling.clear()
+    yield app_module.app.test_client()
+    app_module.scores.clear()
+
+
+@pytest.fixture
+def score_pdf():
+    return _make_score_pdf()
+
+
+def _upload(client, pdf_bytes, filename="score.pdf", **args):
+    response = client.post(
+        "/api/upload",
+        data=pdf_bytes,
+        headers={"Content-Type": "application/pdf", "X-Filename": filename},
+        query_string=args,
+    )
+    assert response.status_code == 201, response.get_json()
+    return response.get_json()
+
+
+@pytest.fixture
+def score_id(client, score_pdf):
+    return _upload(client, score_pdf)["score_id"]
+
+
+def _partition(client, score_id, pages=(0,), **extra):
+    """Partition ``pages`` into one part per stave, using detected dividers."""
+    body = {
+        "display_width": PAGE_WIDTH_PT * 300 // 72,  # display == backend pixels
+        "pages": {},
+        **extra,
+    }
+    for page in pages:
+        detection = client.get(f"/api/scores/{score_id}/pages/{page}/detect").get_json()
+        dividers = detection["dividers"]
+        body["pages"][str(page)] = {
+            "dividers": dividers,
+            "system_flags": detection["system_flags"],
+            "strip_names": [f"Part{i}" for i in range(len(dividers) - 1)],
+        }
+    return client.post(f"/api/scores/{score_id}/partition", json=body)
+
+
+def _decode(data):
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+
+
+# ---------------------------------------------------------------------------
+# Upload
+# ---------------------------------------------------------------------------
+
+def test_raw_upload_reads_filename_header(client, score_pdf):
+    meta = _upload(client, score_pdf, filename="Grande%20Messe.pdf", composer="Berlioz")
+    assert meta["title"] == "Grande Messe"
+    assert meta["composer"] == "Berlioz"
+    assert meta["page_count"] == 2
+    assert meta["pages"][0] == {"page_num": 0, "width": 1250, "height": 1667}
+
+
+def test_multipart_upload(client, score_pdf):
+    response = client.post(
+        "/api/upload",
+        data={"file": (io.BytesIO(score_pdf), "score.pdf"), "title": "T"},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 201
+    assert response.get_json()["title"] == "T"
+
+
+def test_raw_upload_rejects_non_pdf_name(client, score_pdf):
+    response = client.post(
+        "/api/upload",
+        data=score_pdf,
+        headers={"Content-Type": "application/pdf", "X-Filename": "score.png"},
+    )
+    assert response.status_code == 400
+
+
+def test_pool_render_matches_in_process(monkeypatch):
+    monkeypatch.setattr(analyzer, "RENDER_POOL_SIZE", 2)
+    pdf = _make_score_pdf(page_count=analyzer.PARALLEL_RENDER_MIN_PAGES)
+    pooled = analyzer.Score(stream=pdf, title="t", composer="c")
+    pooled._extract_pages()
+    local = analyzer.Score(stream=pdf, title="t", composer="c")
+    local._extract_pages(max_workers=1)
+
+    assert analyzer._render_pool is not None
+    assert pooled.pages_tensor.shape == (analyzer.PARALLEL_RENDER_MIN_PAGES, 1667, 1250)
+    assert np.array_equal(pooled.pages_tensor, local.pages_tensor)
+
+
+def test_mixed_page_sizes_release_the_page_block():
+    doc = fitz.open(stream=_make_score_pdf(page_count=3), filetype="pdf")
+    doc[2].set_mediabox(fitz.Rect(0, 0, PAGE_WIDTH_PT, PAGE_HEIGHT_PT / 2))
+    score = analyzer.Score(stream=doc.tobytes(), title="t", composer="c")
+    score._extract_pages(max_workers=1)
+
+    assert score.pages_tensor is None
+    assert [page.img.shape for page in score.pages] == [(1667, 1250)] * 2 + [(834, 1250)]
+    # Earlier pages were copied out, not left as views of the dropped block
+    assert all(page.img.base is None for page in score.pages[:2])
+
+
+# ---------------------------------------------------------------------------
+# Page images
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("requested, expected", [
+    (300, 512),     # rounded up to a multiple of DISPLAY_WIDTH_STEP
+    (512, 512),
+    (1200, 1250),   # bucket reaches the page width: full size
+    (5000, 1250),
+])
+def test_page_width_is_bucketed(client, score_id, requested, expected):
+    response = client.get(f"/api/scores/{score_id}/pages/0?width={requested}")
+    assert response.status_code == 200
+    assert _decode(response.data).shape[1] == expected
+
+
+def test_page_width_must_be_positive(client, score_id):
+    assert client.get(f"/api/scores/{score_id}/pages/0?width=0").status_code == 400
+
+
+def test_page_format_follows_accept_header(client, score_id):
+    url = f"/api/scores/{score_id}/pages/0"
+    webp = client.get(url, headers={"Accept": "image/webp,*/*"})
+    png = client.get(url)
+    assert webp.mimetype == "image/webp"
+    assert png.mimetype == "image/png"
+    assert "Accept" in webp.headers["Vary"]
+    assert webp.headers["ETag"] != png.headers["ETag"]
+
+
+def test_page_revalidates_with_304(client, score_id):
+    url = f"/api/scores/{score_id}/pages/1"
+    first = client.get(url)
+    again = client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+
+
+# ---------------------------------------------------------------------------
+# Detection and staves
+# ---------------------------------------------------------------------------
+
+def test_detect_is_cacheable_get(client, score_id):
+    url = f"/api/scores/{score_id}/pages/0/detect"
+    first = client.get(url)
+    assert first.status_code == 200
+    assert first.get_json()["stave_count"] == 4
+    assert first.headers["Cache-Control"] == "no-cache"
+    again = client.get(url, headers={"If-None-Match": first.headers["ETag"]})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == first.headers["ETag"]
+    assert client.post(url).status_code == 405
+
+
+def test_stave_revalidates_until_repartitioned(client, score_id):
+    assert _partition(client, score_id).status_code == 200
+    url = f"/api/scores/{score_id}/staves/Part0/0"
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    again = client.get(url, headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+
+    assert _partition(client, score_id).status_code == 200
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_partition_rejects_non_numeric_marking(client, score_id):
+    response = _partition(client, score_id, markings=[{"page": 0, "x": "a", "y": 0, "w": 10, "h": 10}])
+    assert response.status_code == 400
+
+
+def test_partition_rejects_incomplete_header(client, score_id):
+    response = _partition(client, score_id, header={"page": 0, "x": 0, "y": 0, "w": 10})
+    assert response.status_code == 400
+
+
+def _partition_page(client, score_id, dividers, system_flags, names, **extra):
+    """Partition page 0 with explicit dividers (display == backend pixels)."""
+    body = {
+        "display_width": PAGE_WIDTH_PT * 300 // 72,
+        "pages": {"0": {"dividers": dividers, "system_flags": system_flags, "strip_names": names}},
+        **extra,
+    }
+    response = client.post(f"/api/scores/{score_id}/partition", json=body)
+    assert response.status_code == 200, response.get_json()
+    return app_module.scores[score_id]["score"].pages[0].staves
+
+
+def _marking(y, h=40, x=600, w=80):
+    return {"page": 0, "x": x, "y": y, "w": w, "h": h}
+
+
+def test_markings_attach_to_every_staff_of_their_system(client, score_id):
+    # Two systems of two strips; 700-800 is dead space between them
+    staves = _partition_page(
+        client, score_id,
+        [100, 400, 700, 800, 1100, 1400], [True, False, False, True, False, False],
+        ["A", "B", "", "A", "B"],
+        markings=[
+            _marking(120),   # inside the first strip of system 1
+            _marking(980),   # system 2
+            _marking(730),   # dead space: the next system down
+            _marking(1500),  # below every system: the last one
+        ],
+    )
+    assert [[m["y_offset"] for m in staff.markings] for staff in staves] == [
+        [20], [20], [180, -70, 700], [180, -70, 700],
+    ]
+    assert [[m["is_first_in_system"] for m in staff.markings] for staff in staves] == [
+        [True], [False], [True] * 3, [False] * 3,
+    ]
+    assert [m["inside_first"] for m in staves[0].markings + staves[2].markings] == [True, True, False, False]
+    # One crop per marking, shared by the staves of its system
+    assert staves[2].markings[0]["img"] is staves[3].markings[0]["img"]
+
+
+def test_markings_pick_the_first_system_reaching_them(client, score_id):
+    # Overlapping systems, bottoms out of order: 400, 300, 600
+    staves = _partition_page(
+        client, score_id,
+        [100, 400, 200, 300, 500, 600], [True, False, True, False, True, False],
+        ["A", "", "B", "", "C"],
+        markings=[_marking(330), _marking(230), _marking(430)],  # centres 350, 250, 450
+    )
+    assert [staff.name for staff in staves] == ["A", "B", "C"]
+    # As in the original first-match loop: 350 and 250 go to the first system
+    # (bottom 400), 450 to the third; the second (bottom 300) gets none
+    assert [[m["y_offset"] for m in staff.markings] for staff in staves] == [[230, 130], [], [-70]]
+
+
+def _reference_rect_to_backend(rect, scale, img_width, img_height):
+    """The original per-rect conversion."""
+    bx = min(max(round(rect['x'] / scale), 0), img_width)
+    by = min(max(round(rect['y'] / scale), 0), img_height)
+    bw = min(round(rect['w'] / scale), img_width - bx)
+    bh = min(round(rect['h'] / scale), img_height - by)
+    return {'x': bx, 'y': by, 'w': bw, 'h': bh}
+
+
+def test_batched_rect_conversion_matches_per_rect():
+    rects = [
+        {"x": 10.4, "y": 20.6, "w": 100, "h": 50},
+        {"x": 2.5, "y": 3.5, "w": 0.5, "h": 1.5},     # halves round to even
+        {"x": -40, "y": -1, "w": 80, "h": 30},        # origin clamped, size kept
+        {"x": 600, "y": 800, "w": 300, "h": 300},     # size capped at the far edge
+        {"x": 700, "y": 0, "w": 10, "h": 10},         # origin past the edge: w <= 0
+    ]
+    batched = app_module._convert_rects_to_backend(rects, 0.5, 1250, 1667)
+    assert batched == [_reference_rect_to_backend(r, 0.5, 1250, 1667) for r in rects]
+    assert all(type(v) is int for rect in batched for v in rect.values())
+
+
+# ---------------------------------------------------------------------------
+# Score IDs
+# ---------------------------------------------------------------------------
+
+def test_malformed_score_id_is_400(client):
+    assert client.get("/api/scores/not-a-uuid/pages/0").status_code == 400
+
+
+def test_unknown_score_id_is_404(client):
+    unknown = "00000000-0000-0000-0000-000000000000"
+    assert client.get(f"/api/scores/{unknown}/pages/0").status_code == 404
+
+
+# ---------------------------------------------------------------------------
+# Session storage
+# ---------------------------------------------------------------------------
+
+def test_spilled_session_serves_same_images(client, score_id):
+    assert _partition(client, score_id).status_code == 200
+    page_url = f"/api/scores/{score_id}/pages/0"
+    stave_url = f"/api/scores/{score_id}/staves/Part1/0"
+    page_before = client.get(page_url).data
+    stave_before = client.get(stave_url).data
+
+    entry = app_module.scores[score_id]
+    assert app_module._spill_session(score_id, entry)
+    assert isinstance(entry["score"].pages_tensor, np.memmap)
+    assert app_module._session_bytes(entry) < entry["score"].pages_tensor.nbytes
+
+    assert client.get(page_url).data == page_before
+    assert client.get(stave_url).data == stave_before
+
+
+def test_sessions_over_memory_budget_are_spilled(client, score_pdf, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_SESSION_MEMORY_MB", 1)
+    first = _upload(client, score_pdf)["score_id"]
+    second = _upload(client, score_pdf)["score_id"]
+
+    assert app_module.scores[first].get("spilled")
+    assert not app_module.scores[second].get("spilled")
+    assert not app_module._spilling
+    assert client.get(f"/api/scores/{first}/pages/0").status_code == 200
+
+
+def test_session_cap_evicts_coldest(client, score_pdf, monkeypatch):
+    monkeypatch.setattr(app_module, "MAX_SESSIONS", 2)
+    first = _upload(client, score_pdf)["score_id"]
+    second = _upload(client, score_pdf)["score_id"]
+    client.get(f"/api/scores/{first}/pages/0")  # first is now the warmer one
+    third = _upload(client, score_pdf)["score_id"]
+
+    assert list(app_module.scores) == [first, third]
+    assert client.get(f"/api/scores/{second}/pages/0").status_code == 404
+
+
+def test_expired_session_and_its_files_are_removed(client, score_pdf, tmp_path):
+    old = _upload(client, score_pdf)["score_id"]
+    entry = app_module.scores[old]
+    assert app_module._spill_session(old, entry)
+    spill_dir = app_module._spill_path(old)
+    assert os.path.dirname(os.path.dirname(spill_dir)) == str(tmp_path / "sessions")
+    assert os.path.isdir(spill_dir)
+
+    entry["created_at"] -= app_module.SESSION_TTL_SECONDS + 1
+    _upload(client, score_pdf)
+
+    assert old not in app_module.scores
+    assert not os.path.exists(spill_dir)
+    assert client.get(f"/api/scores/{old}/pages/0").status_code == 404
+
+
+def test_ttl_sweep_does_not_depend_on_store_order(client, score_pdf):
+    fresh = _upload(client, score_pdf)["score_id"]
+    stale = _upload(client, score_pdf)["score_id"]
+    app_module.scores.move_to_end(fresh, last=False)  # e.g. a spilled session put back
+    app_module.scores[stale]["created_at"] -= app_module.SESSION_TTL_SECONDS + 1
+    _upload(client, score_pdf)
+
+    assert fresh in app_module.scores
+    assert stale not in app_module.scores
+
+
+# ---------------------------------------------------------------------------
+# Part rendering and PDFs
+# ---------------------------------------------------------------------------
+
+def _generated_part(client, pdf, page_breaks_after=()):
+    """Upload ``pdf``, make Part0 from the first stave of every page and
+    render it. Returns (score_id, Part0)."""
+    score_id = _upload(client, pdf)["score_id"]
+    page_count = app_module.scores[score_id]["score"].doc.page_count
+    assert _partition(client, score_id, pages=range(page_count)).status_code == 200
+    response = client.post(f"/api/scores/{score_id}/generate", json={
+        "parts": {"Part0": {"page_breaks_after": list(page_breaks_after)}},
+    })
+    assert response.status_code == 200, response.get_json()
+    return score_id, app_module.scores[score_id]["score"].parts_dict["Part0"]
+
+
+def test_generate_renders_parts_on_worker_threads(client, score_id, monkeypatch):
+    assert _partition(client, score_id).status_code == 200
+    threads = []
+    process = analyzer.Part.process
+
+    def recording_process(self, *args, **kwargs):
+        threads.append(threading.current_thread())
+        return process(self, *args, **kwargs)
+
+    monkeypatch.setattr(analyzer.Part, "process", recording_process)
+    response = client.post(f"/api/scores/{score_id}/generate", json={"parts": {}})
+    assert response.status_code == 200
+    parts = app_module.scores[score_id]["score"].parts
+    assert [p["page_count"] for p in response.get_json()["parts"]] == [1] * len(parts) == [1] * 4
+    assert len(threads) == 4 and threading.current_thread() not in threads
+
+    # Same pages as rendering the parts one after another
+    threaded = [np.array(part.pages) for part in parts]
+    for part in parts:
+        part.pages = []
+        process(part)
+    assert all(np.array_equal(np.array(part.pages), pages) for part, pages in zip(parts, threaded))
+
+
+def test_generate_validates_every_part_before_rendering(client, score_id):
+    assert _partition(client, score_id).status_code == 200
+    response = client.post(f"/api/scores/{score_id}/generate", json={
+        "parts": {"Part3": {"spacing_mm": 100}},
+    })
+    assert response.status_code == 400
+    assert all(not part.pages for part in app_module.scores[score_id]["score"].parts)
+
+
+def _pdf_page_pixels(doc, page):
+    (xref, *_), = doc[page].get_images(full=True)
+    pixmap = fitz.Pixmap(doc, xref)
+    return np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.width)
+
+
+def test_part_pdf_pages_are_the_rendered_pixels(client):
+    score_id, part = _generated_part(client, _make_score_pdf(page_count=2), page_breaks_after=[0])
+    response = client.get(f"/api/scores/{score_id}/parts/Part0")
+    assert response.status_code == 200
+    assert response.mimetype == "application/pdf"
+
+    doc = fitz.open(stream=response.data, filetype="pdf")
+    assert doc.page_count == len(part.pages) == 2
+    for page_number, pixels in enumerate(part.pages):
+        # A4 at 300 DPI, placed at 72 points per 300 pixels
+        width_pt, height_pt = doc[page_number].rect.br
+        assert (width_pt, height_pt) == pytest.approx((2480 * 72 / 300, 3507 * 72 / 300), abs=1e-3)
+        # Raw grayscale pixmap, not a JPEG: the page comes back exactly
+        assert np.array_equal(_pdf_page_pixels(doc, page_number), pixels)
+
+
+def test_part_pdf_is_streamed_as_an_attachment(client, monkeypatch):
+    score_id, _ = _generated_part(client, _make_score_pdf(page_count=1))
+
+    def no_tobytes(self, *args, **kwargs):
+        raise AssertionError("PDF should be saved into the response buffer, not via tobytes()")
+
+    monkeypatch.setattr(fitz.Document, "tobytes", no_tobytes)
+    response = client.get(f"/api/scores/{score_id}/parts/Part0")
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert response.headers["Content-Disposition"] == "attachment; filename=Part0.pdf"
+    assert int(response.headers["Content-Length"]) == len(response.data)
+    assert response.data.startswith(b"%PDF")
+
+
+def test_part_pdf_is_deflated_and_deduplicated(client):
+    # Pages 2 and 3 hold the same stave at the same height
+    score_id, part = _generated_part(client, _make_score_pdf(page_count=3), page_breaks_after=[0, 1])
+    assert np.array_equal(part.pages[1], part.pages[2])
+    data = client.get(f"/api/scores/{score_id}/parts/Part0").data
+
+    doc = fitz.open(stream=data, filetype="pdf")
+    xrefs = {doc[page].get_images(full=True)[0][0] for page in range(doc.page_count)}
+    assert all(doc.xref_get_key(xref, "Filter") == ("name", "/FlateDecode") for xref in xrefs)
+    assert len(data) < sum(page.nbytes for page in part.pages) // 100
+    # insert_image already shares the repeated image; garbage=4 also merges
+    # the pages' identical content streams
+    assert len(xrefs) == 2
+    assert len({xref for page in doc for xref in page.get_contents()}) == 1
+
+
+def test_part_pdf_is_handed_to_the_proxy(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(app_module, "ACCEL_REDIRECT_PREFIX", "/protected/parts")
+    monkeypatch.setattr(app_module, "PARTS_DIR", str(tmp_path / "parts"))
+    score_id, part = _generated_part(client, _make_score_pdf(page_count=1))
+
+    response = client.get(f"/api/scores/{score_id}/parts/Part0")
+    assert response.status_code == 200
+    assert response.headers["X-Accel-Redirect"] == f"/protected/parts/{score_id}/Part0.pdf"
+    assert response.headers["Content-Disposition"] == "attachment; filename=Part0.pdf"
+    assert response.data == b""
+
+    path = tmp_path / "parts" / score_id / "Part0.pdf"
+    doc = fitz.open(str(path))
+    assert np.array_equal(_pdf_page_pixels(doc, 0), part.pages[0])
+    doc.close()
+    app_module._remove_session_files(score_id)
+    assert not path.parent.exists()
+
+
+# ---------------------------------------------------------------------------
+# Layout helpers
+# ---------------------------------------------------------------------------
+
+def _stave(top, spacing=10):
+    return np.array([top + i * spacing for i in range(5)])
+
+
+@pytest.mark.parametrize("systems, expected", [
+    ([[_stave(100), _stave(200)]], 30),                     # one gap of 60
+    ([[_stave(100), _stave(200), _stave(301)]], 30),       # 60 and 61: floored halves
+    ([[_stave(100), _stave(200)], [_stave(500), _stave(620)]], 35),  # pairs never cross systems
+    ([[_stave(100)], [_stave(300)]], 50),                   # single-stave systems: fallback
+    ([], 50),
+])
+def test_typical_margin_is_median_half_gap(systems, expected):
+    assert app_module._compute_typical_margin(systems) == expected
@@ -0,0 +1,281 @@
+"""Unit tests for the projection pipeline's array helpers.
+
+Several helpers were rewritten with vectorized NumPy. Each is checked
+against the loop it replaced (kept here as a reference) on generated
+peak arrays and projections, so these run without the sample files
+under img/.
+
+Run with:
+    cd backend && pytest tests/ -v
+"""
+
+import statistics
+from fractions import Fraction
+
+import numpy as np
+import pytest
+from scipy.signal import find_peaks
+
+from detection import projection
+
+# ---------------------------------------------------------------------------
+# _trim_stave
+# ---------------------------------------------------------------------------
+
+def _reference_trim_stave(group):
+    """The original loop: drop each line in turn, keep the lowest variance.
+
+    Variance is taken exactly here: the loop used np.var, whose rounding
+    can split exact ties, where _trim_stave keeps the first candidate.
+    """
+    best = None
+    best_var = float('inf')
+    for i in range(len(group)):
+        candidate = np.delete(group, i)
+        gaps = [int(d) for d in np.diff(candidate)]
+        var = Fraction(sum(d * d for d in gaps), len(gaps)) - Fraction(sum(gaps), len(gaps)) ** 2
+        if var < best_var:
+            best_var = var
+            best = candidate
+    return best
+
+
+@pytest.mark.parametrize("group", [
+    [100, 110, 120, 125, 130, 140],  # one extra line mid-stave
+    [95, 100, 110, 120, 130, 140],   # extra line above
+    [100, 110, 120, 130, 140, 152],  # extra line below
+    [100, 110, 120, 130, 140, 150],  # evenly spaced: every candidate ties
+    [1023, 1038, 1051, 1070, 1087],  # exact tie that np.var rounds apart
+    [10, 20, 30],                    # smallest group with a gap left to compare
+])
+def test_trim_stave_matches_reference(group):
+    group = np.array(group)
+    assert np.array_equal(projection._trim_stave(group), _reference_trim_stave(group))
+
+
+def test_trim_stave_matches_reference_on_random_groups():
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        n = int(rng.integers(3, 9))
+        group = np.cumsum(rng.integers(1, 30, size=n)) + int(rng.integers(0, 3000))
+        assert np.array_equal(projection._trim_stave(group), _reference_trim_stave(group))
+
+
+# ---------------------------------------------------------------------------
+# _moving_average
+# ---------------------------------------------------------------------------
+
+@pytest.mark.parametrize("length, size", [
+    (1, 1),
+    (5, 5),      # kernel as long as the input
+    (6, 5),
+    (200, 3),
+    (3509, 41),  # squint blur on a 300 DPI page
+    (3509, 101),
+])
+def test_moving_average_matches_convolve(length, size):
+    values = np.random.default_rng(length + size).integers(0, 2500, length).astype(np.float64)
+    expected = np.convolve(values, np.ones(size) / size, mode='same')
+    np.testing.assert_allclose(projection._moving_average(values, size), expected, rtol=0, atol=1e-9)
+
+
+def test_moving_average_of_empty_projection_is_empty():
+    assert projection._moving_average(np.zeros(0), 5).shape == (0,)
+
+
+# ---------------------------------------------------------------------------
+# cluster_into_staves
+# ---------------------------------------------------------------------------
+
+def _reference_cluster_into_staves(peaks, expected_lines=5, tolerance=0.4):
+    """cluster_into_staves with the original peak-by-peak group walk."""
+    if len(peaks) < expected_lines:
+        return [], peaks.tolist()
+    gaps = np.diff(peaks)
+    k = len(gaps) // 4
+    typical_spacing = np.partition(gaps, k)[k]
+    max_stave_span = typical_spacing * (expected_lines - 1) * (1 + tolerance)
+    max_line_gap = typical_spacing * 2
+
+    groups = []
+    current_group = [peaks[0]]
+    for i, gap in enumerate(gaps):
+        span_with_next = peaks[i + 1] - current_group[0]
+        if gap > max_line_gap or span_with_next > max_stave_span:
+            groups.append(np.array(current_group))
+            current_group = [peaks[i + 1]]
+        else:
+            current_group.append(peaks[i + 1])
+    groups.append(np.array(current_group))
+
+    staves = []
+    orphans = []
+    for group in groups:
+        n = len(group)
+        if n == expected_lines:
+            staves.append(group)
+        elif expected_lines - 2 <= n < expected_lines:
+            repaired = projection._repair_stave(group, expected_lines, typical_spacing, tolerance)
+            if repaired is not None:
+                staves.append(repaired)
+            else:
+                orphans.extend(group.tolist())
+        elif n == expected_lines + 1:
+            staves.append(projection._trim_stave(group))
+        elif n > expected_lines:
+            sub_staves, sub_orphans = projection._split_oversized_group(
+                group, expected_lines, typical_spacing, tolerance
+            )
+            staves.extend(sub_staves)
+            orphans.extend(sub_orphans)
+        else:
+            orphans.extend(group.tolist())
+    return staves, orphans
+
+
+def _synthetic_peaks(rng, n_staves, lines_per_stave=(5,), noise=0):
+    """Staff-line rows: staves ~10 px apart per line, 30-80 px between
+    staves, with jitter and ``noise`` stray peaks."""
+    peaks = []
+    y = int(rng.integers(50, 200))
+    for _ in range(n_staves):
+        spacing = int(rng.integers(8, 13))
+        for line in range(int(rng.choice(lines_per_stave))):
+            peaks.append(y + line * spacing + int(rng.integers(-1, 2)))
+        y = peaks[-1] + int(rng.integers(30, 80))
+    peaks.extend(rng.integers(0, y, noise).tolist())
+    return np.unique(peaks)
+
+
+def _assert_same_clustering(peaks):
+    staves, orphans = projection.cluster_into_staves(peaks)
+    ref_staves, ref_orphans = _reference_cluster_into_staves(peaks)
+    assert [s.tolist() for s in staves] == [s.tolist() for s in ref_staves]
+    assert orphans == ref_orphans
+
+
+@pytest.mark.parametrize("peaks", [
+    [],
+    [100, 110, 120],                               # too few for a stave
+    [100, 110, 120, 130, 140],                     # one group of exactly 5
+    [100, 110, 120, 125, 130, 140],                # one group of 6: trimmed
+    [100, 110, 120, 130, 140, 190, 200, 210, 220, 230],
+    [100, 110, 120, 130, 140, 150, 160, 170, 180, 190, 200],  # one long run: span splits
+    [100, 110, 120, 130, 140, 300, 310, 320, 330],  # second stave missing a line
+])
+def test_cluster_into_staves_matches_reference(peaks):
+    _assert_same_clustering(np.array(peaks, dtype=np.int64))
+
+
+def test_cluster_into_staves_matches_reference_on_random_peaks():
+    rng = np.random.default_rng(0)
+    for _ in range(300):
+        peaks = _synthetic_peaks(
+            rng, int(rng.integers(1, 13)), lines_per_stave=(4, 5, 5, 5, 6), noise=int(rng.integers(0, 6))
+        )
+        _assert_same_clustering(peaks)
+
+
+# ---------------------------------------------------------------------------
+# _squint_rescue
+# ---------------------------------------------------------------------------
+
+def _reference_squint_rescue(proj, staves, orphans, expected_lines=5):
+    """_squint_rescue with the original per-stave and per-hill loops."""
+    if not orphans or not staves:
+        return staves, orphans
+    typical_span = int(statistics.median([int(s[-1] - s[0]) for s in staves]))
+    typical_spacing = typical_span / (expected_lines - 1)
+    blur_kernel = typical_span if typical_span % 2 == 1 else typical_span + 1
+    blurred = projection._moving_average(proj, blur_kernel)
+    hills, _ = find_peaks(blurred, distance=int(typical_span * 0.8), prominence=np.max(blurred) * 0.08)
+
+    cover_margin = int(typical_span * 0.5)
+    covered_ranges = [(int(s[0]) - cover_margin, int(s[-1]) + cover_margin) for s in staves]
+    first_stave_top = min(int(s[0]) for s in staves)
+    last_stave_bottom = max(int(s[-1]) for s in staves)
+    sorted_staves = sorted(staves, key=lambda s: s[0])
+    inter_stave_gaps = [
+        int(sorted_staves[i + 1][0] - sorted_staves[i][-1]) for i in range(len(sorted_staves) - 1)
+    ]
+    page_margin = max(inter_stave_gaps) * 2 if inter_stave_gaps else typical_span
+    known_heights = [
+        blurred[int(np.mean(s))] for s in staves if 0 <= int(np.mean(s)) < len(blurred)
+    ]
+    min_hill_height = statistics.median(known_heights) * 0.6 if known_heights else 0
+
+    rescued = []
+    current_bottom = last_stave_bottom
+    for center in sorted(hills):
+        c = int(center)
+        if any(lo <= c <= hi for lo, hi in covered_ranges):
+            continue
+        if c < first_stave_top - page_margin or c > current_bottom + page_margin:
+            continue
+        if blurred[c] < min_hill_height:
+            continue
+        top = int(round(center - typical_spacing * 2))
+        stave = np.array([int(round(top + i * typical_spacing)) for i in range(expected_lines)])
+        rescued.append(stave)
+        current_bottom = max(current_bottom, int(stave[-1]))
+
+    rescued_ranges = [(int(s[0]) - 5, int(s[-1]) + 5) for s in rescued]
+    remaining = [o for o in orphans if not any(lo <= o <= hi for lo, hi in rescued_ranges)]
+    return staves + rescued, remaining
+
+
+def _synthetic_page(rng, n_staves, n_missed):
+    """A row projection of ``n_staves`` 5-line staves, plus the first-pass
+    result that missed ``n_missed`` of them (their lines left as orphans)."""
+    proj = np.zeros(int(rng.integers(1500, 3500)))
+    all_staves = []
+    y = int(rng.integers(40, 150))
+    spacing = int(rng.integers(8, 14))
+    for _ in range(n_staves):
+        stave = y + spacing * np.arange(5)
+        if stave[-1] + 20 >= len(proj):
+            break
+        proj[stave] = rng.integers(800, 1200, 5)
+        all_staves.append(stave)
+        y = int(stave[-1]) + int(rng.integers(40, 160))
+    proj += rng.integers(0, 60, len(proj))  # notes and text
+    missed = set(rng.choice(len(all_staves), min(n_missed, len(all_staves)), replace=False).tolist())
+    staves = [s for i, s in enumerate(all_staves) if i not in missed]
+    orphans = sorted(int(y) for i in missed for y in all_staves[i][::2])
+    return proj, staves, orphans
+
+
+def _assert_same_rescue(proj, staves, orphans):
+    new_staves, new_orphans = projection._squint_rescue(proj, list(staves), list(orphans))
+    ref_staves, ref_orphans = _reference_squint_rescue(proj, list(staves), list(orphans))
+    assert [s.tolist() for s in new_staves] == [s.tolist() for s in ref_staves]
+    assert list(new_orphans) == list(ref_orphans)
+    return len(new_staves) - len(staves)
+
+
+def test_squint_rescue_without_staves_or_orphans_is_a_no_op():
+    proj, staves, orphans = _synthetic_page(np.random.default_rng(1), 6, 2)
+    assert projection._squint_rescue(proj, [], orphans) == ([], orphans)
+    assert projection._squint_rescue(proj, staves, []) == (staves, [])
+
+
+def test_squint_rescue_with_a_single_known_stave():
+    # No inter-stave gap to learn from: the reach is one stave span
+    proj = np.zeros(600)
+    known = 100 + 10 * np.arange(5)
+    missed = 160 + 10 * np.arange(5)
+    proj[known] = proj[missed] = 1000
+    assert _assert_same_rescue(proj, [known], missed[::2].tolist()) == 1
+    staves, orphans = projection._squint_rescue(proj, [known], missed[::2].tolist())
+    assert staves[1].tolist() == missed.tolist()
+    assert orphans == []
+
+
+def test_squint_rescue_matches_reference_on_random_pages():
+    rng = np.random.default_rng(0)
+    rescued = 0
+    for _ in range(200):
+        proj, staves, orphans = _synthetic_page(rng, int(rng.integers(2, 13)), int(rng.integers(1, 4)))
+        if staves:
+            rescued += _assert_same_rescue(proj, staves, orphans)
+    assert rescued > 0  # the generated pages do exercise the rescue path
@@ -0,0 +1,10 @@
+"""WSGI entry point for production servers.
+
+	cd backend
+	gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 wsgi:app
+
+Sessions are kept in process memory, so run a single worker and get
+concurrency from threads: rendering, detection and PDF assembly spend
+most of their time in OpenCV/NumPy/MuPDF with the GIL released.
+"""
+from app import app  # noqa: F401
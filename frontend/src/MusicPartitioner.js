@@ -12,6 +12,9 @@ const STRIP_COLUMN_WIDTH = 160;
 const ANNOTATIONS_PANEL_WIDTH = 176; // w-44 = 11rem = 176px
 const GAP = 16;
 const MIN_PAGE_WIDTH = 400;
+// Page images are fetched downscaled for display (~185 DPI for A4); all
+// coordinates still use the backend's full-resolution page pixels.
+const PAGE_IMAGE_WIDTH = 1536; // a multiple of the backend's 256px width buckets
 
 const MusicPartitioner = () => {
   // --- App lifecycle ---
@@ -316,13 +319,15 @@ const MusicPartitioner = () => {
     setUploading(true);
     setError(null);
 
-    const formData = new FormData();
-    formData.append('file', file);
-
     try {
+      // Send the raw PDF so the backend can stream it without multipart parsing
       const response = await fetch('/api/upload', {
         method: 'POST',
-        body: formData,
+        headers: {
+          'Content-Type': 'application/pdf',
+          'X-Filename': encodeURIComponent(file.name),
+        },
+        body: file,
       });
 
       if (!response.ok) {
@@ -354,7 +359,7 @@ const MusicPartitioner = () => {
       // Reset prevPageWidthRef so rescaling doesn't trigger on fresh upload
       prevPageWidthRef.current = null;
 
-      setPageImageUrl(`/api/scores/${data.score_id}/pages/0`);
+      setPageImageUrl(`/api/scores/${data.score_id}/pages/0?width=${PAGE_IMAGE_WIDTH}`);
       setPhase('edit');
     } catch (err) {
       setError(err.message);
@@ -416,7 +421,7 @@ const MusicPartitioner = () => {
     }
 
     setCurrentPage(pageNum);
-    setPageImageUrl(`/api/scores/${scoreId}/pages/${pageNum}`);
+    setPageImageUrl(`/api/scores/${scoreId}/pages/${pageNum}?width=${PAGE_IMAGE_WIDTH}`);
   }, [scoreMetadata, scoreId, confirmedPages, autoDetect, getLatestConfirmedDividers, getLatestConfirmedStripNames, getLatestConfirmedSystemDividers, dividersByPage, systemDividersByPage, deriveStrips, buildGlobalKnownSequence, fillPageNames]);
 
   // --- Staff detection ---
@@ -429,9 +434,7 @@ const MusicPartitioner = () => {
     setDetectingPage(pageNum);
 
     try {
-      const response = await fetch(`/api/scores/${scoreId}/pages/${pageNum}/detect`, {
-        method: 'POST',
-      });
+      const response = await fetch(`/api/scores/${scoreId}/pages/${pageNum}/detect`);
 
       if (!response.ok) {
         console.warn(`Detection failed for page ${pageNum}: HTTP ${response.status}`);